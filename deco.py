@@ -1,17 +1,53 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from functools import update_wrapper
+import asyncio
+import cProfile
+import json
+import re
+import threading
 
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import redirect_stdout
+from contextvars import ContextVar
+from functools import partial, update_wrapper
+from inspect import iscoroutinefunction
+from io import StringIO
+from itertools import count
+from time import monotonic, perf_counter_ns, sleep
 
-def disable(func):
+MEMO_MAXSIZE = 1024
+
+# separates positional and keyword arguments in memo keys
+KWARGS_MARK = object()
+# value passed to callers waiting for interrupted computation, they compute the value themselves
+MEMO_RETRY = object()
+
+# bucket i of latency histogram counts latencies from 2 ** (i - 1) to 2 ** i - 1 nanoseconds,
+# int64 nanoseconds always fit
+HISTOGRAM_BUCKETS = 64
+
+# name -> statistics of timed and profiled functions
+TIMINGS = {}
+
+# only one profiler may be active, nested profiled calls are only timed
+profile_lock = threading.Lock()
+
+timing_enabled = True
+
+
+def disable(func=None, **options):
     """
     Disable a decorator by re-assigning the decorator's name
     to this function. For example, to turn off memoization:
 
     >>> memo = disable
 
+    Options of decorators, e.g. @memo(maxsize=100), are ignored.
     """
+    if func is None:
+        return disable
     return func
 
 
@@ -28,30 +64,194 @@ def decorator(dec):
 
 @decorator
 def countcalls(func):
-    """Decorator that counts calls made to the function decorated."""
-    def wrapper(*args, **kwargs):
-        wrapper.calls += 1
-        return func(*args, **kwargs)
+    """
+    Decorator that counts calls made to the function decorated.
+    Calls from several threads are counted atomically,
+    calls of coroutine function are counted when it is called.
+    """
+    lock = threading.Lock()
+
+    def count():
+        with lock:
+            wrapper.calls += 1
+
+    if iscoroutinefunction(func):
+        async def wrapper(*args, **kwargs):
+            count()
+            return await func(*args, **kwargs)
+    else:
+        def wrapper(*args, **kwargs):
+            count()
+            return func(*args, **kwargs)
 
     wrapper.calls = 0
 
     return wrapper
 
 
-@decorator
-def memo(func):
+def memo(func=None, maxsize=MEMO_MAXSIZE, ttl=None):
     """
-    Memoize a function so that it caches all return values for
-    faster future lookups.
+    Memoize a function so that it caches return values for
+    faster future lookups. Least recently used values are evicted
+    when there are more than maxsize values (None means no limit),
+    values older than ttl seconds are computed again.
+    Calls with unhashable arguments are not cached.
+    Concurrent calls with the same arguments from several threads
+    or asyncio tasks wait for the value computed by the first of them,
+    coroutine functions are awaited without blocking event loop.
+    If the first call is interrupted, e.g. its task is cancelled,
+    one of waiting calls computes the value instead.
+
+    >>> @memo(maxsize=100, ttl=60)
+    ... def f(x): ...
+    >>> f.cache_info()
+    {'hits': 0, 'misses': 0, 'evictions': 0, 'size': 0, 'maxsize': 100, 'ttl': 60}
+    >>> f.cache_clear()
+
     """
-    def wrapper(*args, **kwargs):
-        key = str(args) + str(kwargs)
-        if key not in wrapper.cache:
-            wrapper.cache[key] = func(*args, **kwargs)
-        update_wrapper(wrapper, func)
-        return wrapper.cache[key]
+    if func is None:
+        return partial(memo, maxsize=maxsize, ttl=ttl)
+
+    cache = OrderedDict()
+    stats = {"hits": 0, "misses": 0, "evictions": 0}
+    # key -> (future of value, thread or asyncio task computing it)
+    computing = {}
+    lock = threading.Lock()
+
+    def cached(key):
+        """Returns fresh cached (value, expires) entry of key or None"""
+        with lock:
+            entry = cache.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > monotonic()):
+                stats["hits"] += 1
+                cache.move_to_end(key)
+                return entry
+        return None
+
+    def lookup(key, owner):
+        """
+        Returns cached (value, expires) entry or future of the value computed
+        by other owner. If both are None the caller must compute the value,
+        its computation is registered unless the caller is already computing it
+        """
+        with lock:
+            entry = cache.get(key)
+            if entry is not None:
+                if entry[1] is None or entry[1] > monotonic():
+                    stats["hits"] += 1
+                    cache.move_to_end(key)
+                    return entry, None
+                del cache[key]
+                stats["evictions"] += 1
+
+            computation = computing.get(key)
+            if computation is not None and computation[1] != owner:
+                stats["hits"] += 1
+                return None, computation[0]
+            stats["misses"] += 1
+            if computation is None:
+                computing[key] = (Future(), owner)
+            return None, None
+
+    def store(key, owner, result=None, error=None):
+        """Cache computed value and pass it or error to waiting callers"""
+        # attributes of decorated function, e.g. calls of countcalls, are changed only by its calls
+        update_wrapper(wrapper, func, assigned=())
+        with lock:
+            computation = computing.get(key)
+            if computation is not None and computation[1] == owner:
+                del computing[key]
+            else:
+                computation = None
+            if error is None:
+                cache[key] = (result, monotonic() + ttl if ttl is not None else None)
+                if maxsize is not None and len(cache) > maxsize:
+                    cache.popitem(last=False)
+                    stats["evictions"] += 1
+        if computation is not None:
+            if error is None:
+                computation[0].set_result(result)
+            elif isinstance(error, Exception):
+                computation[0].set_exception(error)
+            else:
+                # cancellation or interruption of the owner is not an error of the other callers
+                computation[0].set_result(MEMO_RETRY)
+
+    def uncached(args, kwargs):
+        with lock:
+            stats["misses"] += 1
+        return func(*args, **kwargs)
 
-    wrapper.cache = {}
+    if iscoroutinefunction(func):
+        async def wrapper(*args, **kwargs):
+            key = args + (KWARGS_MARK,) + tuple(sorted(kwargs.items())) if kwargs else args
+            try:
+                entry = cached(key)
+            except TypeError:
+                return await uncached(args, kwargs)
+            if entry is not None:
+                return entry[0]
+
+            owner = asyncio.current_task()
+            while True:
+                entry, future = lookup(key, owner)
+                if entry is not None:
+                    return entry[0]
+                if future is None:
+                    break
+                # cancellation of waiting task doesn't cancel computation
+                result = await asyncio.shield(asyncio.wrap_future(future))
+                if result is not MEMO_RETRY:
+                    return result
+
+            try:
+                result = await func(*args, **kwargs)
+            except BaseException as error:
+                store(key, owner, error=error)
+                raise
+            store(key, owner, result)
+            return result
+    else:
+        def wrapper(*args, **kwargs):
+            key = args + (KWARGS_MARK,) + tuple(sorted(kwargs.items())) if kwargs else args
+            try:
+                entry = cached(key)
+            except TypeError:
+                return uncached(args, kwargs)
+            if entry is not None:
+                return entry[0]
+
+            owner = threading.get_ident()
+            while True:
+                entry, future = lookup(key, owner)
+                if entry is not None:
+                    return entry[0]
+                if future is None:
+                    break
+                result = future.result()
+                if result is not MEMO_RETRY:
+                    return result
+
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as error:
+                store(key, owner, error=error)
+                raise
+            store(key, owner, result)
+            return result
+
+    def cache_info():
+        with lock:
+            return dict(stats, size=len(cache), maxsize=maxsize, ttl=ttl)
+
+    def cache_clear():
+        with lock:
+            cache.clear()
+            stats.update(hits=0, misses=0, evictions=0)
+
+    update_wrapper(wrapper, func)
+    wrapper.cache_info = cache_info
+    wrapper.cache_clear = cache_clear
 
     return wrapper
 
@@ -92,24 +292,212 @@ def trace(annotation):
 
     @decorator
     def dec(func):
-        def wrapper(*args, **kwargs):
-            func_info = func.__name__ + "(" + ".".join(map(str, args)) + ")"
+        # depth of calls is separate for every thread and asyncio task
+        level = ContextVar("level", default=0)
 
-            if wrapper.level == 0:
+        def enter(args):
+            func_info = func.__name__ + "(" + ".".join(map(str, args)) + ")"
+            depth = level.get()
+            if depth == 0:
                 print("{} {}".format(header, func_info))
-            print("{} --> {}".format(annotation * wrapper.level, func_info))
-            wrapper.level += 1
-
-            result = func(*args, **kwargs)
-
-            wrapper.level -= 1
-            print("{} <-- {} == {}".format(annotation * wrapper.level, func_info, result))
-            return result
-        wrapper.level = 0
+            print("{} --> {}".format(annotation * depth, func_info))
+            return func_info, level.set(depth + 1)
+
+        def leave(func_info, token, result):
+            level.reset(token)
+            print("{} <-- {} == {}".format(annotation * level.get(), func_info, result))
+
+        if iscoroutinefunction(func):
+            async def wrapper(*args, **kwargs):
+                func_info, token = enter(args)
+                try:
+                    result = await func(*args, **kwargs)
+                except BaseException:
+                    level.reset(token)
+                    raise
+                leave(func_info, token, result)
+                return result
+        else:
+            def wrapper(*args, **kwargs):
+                func_info, token = enter(args)
+                try:
+                    result = func(*args, **kwargs)
+                except BaseException:
+                    level.reset(token)
+                    raise
+                leave(func_info, token, result)
+                return result
         return wrapper
     return dec
 
 
+def set_timing(enabled):
+    """
+    Turn recording of timed and profiled functions on or off at run time,
+    while it is off decorated functions are called directly.
+    To remove timing completely re-assign the decorator's name,
+    options such as @timed(sample=100) are ignored then:
+
+    >>> timed = disable
+
+    """
+    global timing_enabled
+    timing_enabled = enabled
+
+
+def timed(func=None, name=None, sample=1, profile=False):
+    """
+    Record latency of calls to function decorated in TIMINGS registry
+    under name ("module.qualname" by default). Every call is counted,
+    only every sample-th call is timed: its latency is added to cumulative
+    and max latency and to histogram with power of two nanoseconds buckets,
+    total time is estimated from them. With profile sampled calls are also
+    profiled with cProfile (coroutine functions are only timed).
+    Calls from several threads and asyncio tasks are recorded atomically.
+
+    >>> @timed(sample=100)
+    ... def f(x): ...
+    >>> print(timings_report())
+
+    """
+    if func is None:
+        return partial(timed, name=name, sample=sample, profile=profile)
+
+    name = name or "{}.{}".format(func.__module__, func.__qualname__)
+    # next() of counter is atomic, so calls which are not sampled don't take the lock
+    stats = TIMINGS[name] = {"counter": count(1), "lock": threading.Lock(), "sample": sample}
+    timings_reset(stats)
+
+    def record(counter, call, elapsed):
+        with stats["lock"]:
+            if counter is not stats["counter"]:
+                # call started before timings_clear
+                return
+            stats["sampled"] += 1
+            stats["total_ns"] += elapsed
+            if elapsed > stats["max_ns"]:
+                stats["max_ns"] = elapsed
+            stats["histogram"][elapsed.bit_length()] += 1
+
+    def profiled_call(args, kwargs):
+        if not profile_lock.acquire(blocking=False):
+            return func(*args, **kwargs)
+        try:
+            if stats["profile"] is None:
+                stats["profile"] = cProfile.Profile()
+            return stats["profile"].runcall(func, *args, **kwargs)
+        finally:
+            profile_lock.release()
+
+    if iscoroutinefunction(func):
+        async def wrapper(*args, **kwargs):
+            if not timing_enabled:
+                return await func(*args, **kwargs)
+            counter = stats["counter"]
+            call = next(counter)
+            if call % sample:
+                return await func(*args, **kwargs)
+            start = perf_counter_ns()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                record(counter, call, perf_counter_ns() - start)
+    else:
+        def wrapper(*args, **kwargs):
+            if not timing_enabled:
+                return func(*args, **kwargs)
+            counter = stats["counter"]
+            call = next(counter)
+            if call % sample:
+                return func(*args, **kwargs)
+            start = perf_counter_ns()
+            try:
+                return profiled_call(args, kwargs) if profile else func(*args, **kwargs)
+            finally:
+                record(counter, call, perf_counter_ns() - start)
+
+    update_wrapper(wrapper, func)
+    wrapper.timing_name = name
+
+    return wrapper
+
+
+def profiled(func=None, name=None, sample=1):
+    """timed with cProfile statistics of sampled calls"""
+    return timed(func, name=name, sample=sample, profile=True)
+
+
+def histogram_quantile(histogram, sampled, q):
+    """Upper bound in nanoseconds of histogram bucket with q-quantile of latency"""
+    rank = q * sampled
+    seen = 0
+    for bucket, number in enumerate(histogram):
+        seen += number
+        if number and seen >= rank:
+            return 2 ** bucket - 1
+    return 0
+
+
+def export_timings(file_name=None):
+    """
+    Return statistics of timed functions as dictionary name -> statistics,
+    histogram is {bucket upper bound in nanoseconds: number of calls}.
+    Total time is estimated from sampled calls.
+    With file_name statistics is saved there as JSON and cProfile statistics
+    of profiled functions is saved as "<file_name>.<name>.pstats"
+    """
+    timings = {}
+    for name, stats in list(TIMINGS.items()):
+        with stats["lock"]:
+            # repr of count is "count(<next value>)", reading it doesn't take a ticket of a call
+            calls = int(repr(stats["counter"])[len("count("):-1]) - 1
+            stats = dict(stats, histogram=list(stats["histogram"]))
+        sampled = stats["sampled"]
+        timings[name] = {
+            "calls": calls,
+            "sampled": sampled,
+            "sample": stats["sample"],
+            "total_ns": stats["total_ns"] * calls // sampled if sampled else 0,
+            "avg_ns": stats["total_ns"] // sampled if sampled else 0,
+            "max_ns": stats["max_ns"],
+            "p50_ns": min(histogram_quantile(stats["histogram"], sampled, 0.5), stats["max_ns"]),
+            "p99_ns": min(histogram_quantile(stats["histogram"], sampled, 0.99), stats["max_ns"]),
+            "histogram": {2 ** bucket - 1: number for bucket, number in enumerate(stats["histogram"]) if number},
+        }
+        if file_name and stats["profile"] is not None:
+            stats["profile"].dump_stats("{}.{}.pstats".format(file_name, name))
+
+    if file_name:
+        with open(file_name, "w") as timings_file:
+            json.dump(timings, timings_file, indent=2)
+    return timings
+
+
+def timings_report():
+    """Text table of timed functions sorted by total time, latencies in microseconds"""
+    lines = ["{:<40} {:>10} {:>10} {:>12} {:>10} {:>10} {:>10} {:>10}".format(
+        "name", "calls", "sampled", "total_s", "avg_us", "p50_us", "p99_us", "max_us")]
+    timings = export_timings()
+    for name in sorted(timings, key=lambda name: timings[name]["total_ns"], reverse=True):
+        stats = timings[name]
+        lines.append("{:<40} {:>10} {:>10} {:>12.3f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+            name, stats["calls"], stats["sampled"], stats["total_ns"] / 1e9, stats["avg_ns"] / 1e3,
+            stats["p50_ns"] / 1e3, stats["p99_ns"] / 1e3, stats["max_ns"] / 1e3))
+    return "\n".join(lines)
+
+
+def timings_reset(stats):
+    with stats["lock"]:
+        stats.update(counter=count(1), sampled=0, total_ns=0, max_ns=0,
+                     histogram=[0] * HISTOGRAM_BUCKETS, profile=None)
+
+
+def timings_clear():
+    """Forget statistics recorded by all timed functions"""
+    for stats in list(TIMINGS.values()):
+        timings_reset(stats)
+
+
 @memo
 @countcalls
 @n_ary
@@ -132,6 +520,24 @@ def fib(n):
     return 1 if n <= 1 else fib(n-1) + fib(n-2)
 
 
+@memo
+@countcalls
+def slow_square(x):
+    sleep(0.1)
+    return x * x
+
+
+@memo
+@countcalls
+async def async_square(x):
+    await asyncio.sleep(0.1)
+    return x * x
+
+
+async def gather_squares():
+    return await asyncio.gather(*(async_square(i % 2) for i in range(10)))
+
+
 def main():
     print("disable.__doc__ =", disable.__doc__)
     print("decorator.__doc__=", decorator.__doc__)
@@ -139,6 +545,7 @@ def main():
     print("memo.__doc__ =", memo.__doc__)
     print("n_ary.__doc__ =", n_ary.__doc__)
     print("trace.__doc__ =", trace.__doc__)
+    print("timed.__doc__ =", timed.__doc__)
 
     print(foo(4, 3))
     print(foo(4, 3, 2))
@@ -153,7 +560,199 @@ def main():
     print(fib.__doc__)
     fib(3)
     print(fib.calls, 'calls made')
+    print("fib cache:", fib.cache_info())
+
+    fib.cache_clear()
+    fib(3)
+    print(fib.calls, 'calls made after cache_clear')
+
+    with ThreadPoolExecutor(8) as executor:
+        print(list(executor.map(slow_square, [3] * 16)))
+    print("slow_square was computed", slow_square.calls, "times, cache:", slow_square.cache_info())
+
+    print(asyncio.run(gather_squares()))
+    print("async_square was computed", async_square.calls, "times, cache:", async_square.cache_info())
+
+    # demo functions are decorated here to keep them out of TIMINGS of importing modules
+    @timed(name="sum_squares", sample=10)
+    def sum_squares(n):
+        return sum(i * i for i in range(n))
+
+    @profiled(name="sorted_squares")
+    def sorted_squares(n):
+        return sorted((i * i) % 1000 for i in range(n))
+
+    for n in range(1000):
+        sum_squares(n)
+        sorted_squares(n % 10)
+    set_timing(False)
+    sum_squares(10)
+    set_timing(True)
+    print(timings_report())
+    print("sum_squares timings:", export_timings()[sum_squares.timing_name])
+
+
+def test_disable():
+    print("test_disable...")
+
+    def identity(x):
+        return x
+
+    assert disable(identity) is identity
+    assert disable(maxsize=10, ttl=60)(identity) is identity
+    assert disable(sample=100)(identity) is identity
+    print('OK')
+
+
+def test_countcalls_threads():
+    print("test_countcalls_threads...")
+
+    @countcalls
+    def noop():
+        pass
+
+    def call_many():
+        for _ in range(10000):
+            noop()
+
+    threads = [threading.Thread(target=call_many) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert noop.calls == 80000
+    print('OK')
+
+
+def test_memo_single_flight():
+    print("test_memo_single_flight...")
+
+    @memo
+    @countcalls
+    def slow_square(x):
+        sleep(0.05)
+        return x * x
+
+    with ThreadPoolExecutor(8) as executor:
+        assert list(executor.map(slow_square, [3] * 16 + [4] * 16)) == [9] * 16 + [16] * 16
+    assert slow_square.calls == 2
+    assert slow_square.cache_info()["misses"] == 2 and slow_square.cache_info()["hits"] == 30
+
+    @memo
+    @countcalls
+    async def async_square(x):
+        await asyncio.sleep(0.05)
+        return x * x
+
+    async def gather_squares():
+        return await asyncio.gather(*(async_square(i % 2) for i in range(10)))
+
+    assert asyncio.run(gather_squares()) == [0, 1] * 5
+    assert async_square.calls == 2
+    assert async_square.cache_info()["misses"] == 2 and async_square.cache_info()["hits"] == 8
+
+    # errors of computation are passed to waiting callers and are not cached
+    @memo
+    @countcalls
+    def failing(x):
+        sleep(0.05)
+        raise ValueError(x)
+
+    def call_failing(x):
+        try:
+            failing(x)
+        except ValueError as error:
+            return error.args
+    with ThreadPoolExecutor(4) as executor:
+        assert list(executor.map(call_failing, [1] * 4)) == [(1,)] * 4
+    assert failing.calls == 1
+    assert call_failing(1) == (1,) and failing.calls == 2
+    print('OK')
+
+
+def test_trace_context():
+    print("test_trace_context...")
+
+    @trace("..")
+    async def countdown(name, n):
+        await asyncio.sleep(0)
+        return name if n == 0 else await countdown(name, n - 1)
+
+    async def run():
+        return await asyncio.gather(countdown("a", 2), countdown("b", 2))
+
+    output = StringIO()
+    with redirect_stdout(output):
+        assert asyncio.run(run()) == ["a", "b"]
+    # interleaved tasks keep their own depth of calls
+    calls = re.findall(r"^((?:\.\.)*) (?:-->|<--) countdown\((\w)\.(\d)\)", output.getvalue(), re.MULTILINE)
+    assert len(calls) == 12
+    for prefix, name, n in calls:
+        assert len(prefix) // 2 == 2 - int(n), output.getvalue()
+    assert re.findall(r"^>>> countdown\((\w)\.2\)$", output.getvalue(), re.MULTILINE) == ["a", "b"]
+    print('OK')
+
+
+def test_timed():
+    print("test_timed...")
+
+    @timed(name="test_timed.identity", sample=100)
+    def identity(x):
+        return x
+
+    for i in range(99):
+        identity(i)
+    stats = export_timings()["test_timed.identity"]
+    assert (stats["calls"], stats["sampled"], stats["total_ns"]) == (99, 0, 0)
+    for i in range(51):
+        identity(i)
+    stats = export_timings()["test_timed.identity"]
+    # export doesn't change number of calls
+    assert export_timings()["test_timed.identity"]["calls"] == stats["calls"] == 150
+    assert stats["sampled"] == 1 and sum(stats["histogram"].values()) == 1
+    assert stats["total_ns"] == stats["max_ns"] * 150
+
+    set_timing(False)
+    identity(0)
+    set_timing(True)
+    assert export_timings()["test_timed.identity"]["calls"] == 150
+    timings_clear()
+    assert export_timings()["test_timed.identity"]["calls"] == 0
+    del TIMINGS["test_timed.identity"]
+    print('OK')
+
+
+def test_memo_cancelled_owner():
+    print("test_memo_cancelled_owner...")
+    computed = []
+
+    @memo
+    async def slow_double(x):
+        computed.append(x)
+        await asyncio.sleep(0.05)
+        return 2 * x
+
+    async def run():
+        owner = asyncio.ensure_future(slow_double(1))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.ensure_future(slow_double(1))
+        await asyncio.sleep(0.01)
+        owner.cancel()
+        # waiting task computes the value instead of getting CancelledError of the owner
+        assert await waiter == 2
+        assert owner.cancelled()
+        assert await slow_double(1) == 2
+
+    asyncio.run(run())
+    assert computed == [1, 1]
+    print('OK')
 
 
 if __name__ == '__main__':
     main()
+    test_disable()
+    test_countcalls_threads()
+    test_memo_single_flight()
+    test_trace_context()
+    test_timed()
+    test_memo_cancelled_owner()
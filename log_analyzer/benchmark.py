@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+import gzip
+import json
+import multiprocessing
+import optparse
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+import timeit
+
+import log_analyzer
+
+LOG_LINE = '{} {}  - [29/Jun/2017:03:50:22 +0300] "{} {} HTTP/1.1" {} {} "-" "{}" "-" "{}" "{}" {:.3f}\n'
+
+BROKEN_LINES = ['1.202.56.176 -  - [29/Jun/2017:09:48:16 +0300] "0" 400 166 "-" "-" "-" "-" "-" 0.005\n',
+                '1.202.56.176 -  - [29/Jun/2017:09:48:16 +0300] "\\x16\\x03\\x01\\x00" 400 166 "-" "-" "-" "-" "-"\n',
+                'upstream timed out while reading response header from upstream\n']
+
+URL_TEMPLATES = ["/api/v2/banner/{}",
+                 "/api/v2/group/{}/banners",
+                 "/api/v2/slot/{}/groups",
+                 "/api/v2/internal/banner/{}/info",
+                 "/api/1/photogenic_banners/list/?server_name=WIN{}",
+                 "/export/appinstall_raw/2017-06-{}/"]
+
+USER_AGENTS = ["Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5",
+               "Python-urllib/2.7",
+               "Slotovod",
+               "Configovod",
+               "python-requests/2.13.0",
+               "Mozilla/5.0 (Windows; U; Windows NT 6.0; ru; rv:1.9.0.12) Gecko/2009070611 Firefox/3.0.12",
+               "-"]
+
+STAGES = ("find_last_log_file", "parse_log_file", "prepare_report", "write_report_to_html")
+
+
+def generate_log(file_name, size, urls_count=10000, error_ratio=0.0, seed=46):
+    """
+    Generate deterministic ui_short log of approximately size bytes before compression,
+    file with .gz extension is gzip compressed. Urls popularity follows
+    Zipf distribution, error_ratio of lines are malformed.
+    Returns number of lines and uncompressed size
+    """
+
+    generator = random.Random(seed)
+    urls = [URL_TEMPLATES[i % len(URL_TEMPLATES)].format(i) for i in range(urls_count)]
+    cum_weights = []
+    total_weight = 0
+    for i in range(urls_count):
+        total_weight += 1 / (i + 1)
+        cum_weights.append(total_weight)
+
+    lines = 0
+    written = 0
+    with open(file_name, "wb") as raw_file:
+        # empty name and zero mtime in gzip header keep compressed file reproducible
+        log_file = (gzip.GzipFile(filename="", mode="wb", fileobj=raw_file, mtime=0)
+                    if file_name.endswith(".gz") else raw_file)
+        while written < size:
+            chunk = []
+            for url in generator.choices(urls, cum_weights=cum_weights, k=10000):
+                if generator.random() < error_ratio:
+                    chunk.append(generator.choice(BROKEN_LINES))
+                    continue
+                chunk.append(LOG_LINE.format(
+                    "1.{}.{}.{}".format(generator.randrange(256), generator.randrange(256), generator.randrange(256)),
+                    generator.choice(["-", "3b81f63526fa8"]),
+                    "GET" if generator.random() < 0.9 else "POST",
+                    url,
+                    generator.choice([200, 200, 200, 200, 304, 404, 500]),
+                    generator.randrange(20000),
+                    generator.choice(USER_AGENTS),
+                    "1498697422-{}-4708-9752759".format(generator.randrange(10 ** 10)),
+                    "{:x}".format(generator.getrandbits(40)),
+                    generator.lognormvariate(-2, 1.2)))
+            data = "".join(chunk).encode("utf-8")
+            log_file.write(data)
+            lines += len(chunk)
+            written += len(data)
+        log_file.close()
+
+    return lines, written
+
+
+def generate_log_dir(log_dir, size, compress=False, extra_files=1000, **generate_options):
+    """
+    Generate log directory with the latest log file and extra_files
+    empty rotated logs of previous days and unrelated files.
+    Returns name of generated log file, number of its lines and uncompressed size
+    """
+
+    date = datetime.date(2017, 6, 30)
+    for i in range(extra_files):
+        previous_date = date - datetime.timedelta(days=i + 1)
+        if i % 4 == 3:
+            file_name = "nginx-error.log-{:%Y%m%d}".format(previous_date)
+        else:
+            file_name = "nginx-access-ui.log-{:%Y%m%d}{}".format(previous_date, ".gz" if i % 2 else "")
+        open(os.path.join(log_dir, file_name), "w").close()
+
+    file_name = os.path.join(log_dir, "nginx-access-ui.log-{:%Y%m%d}{}".format(date, ".gz" if compress else ""))
+    lines, size = generate_log(file_name, size, **generate_options)
+    return file_name, lines, size
+
+
+def measure_stages(log_dir, report_dir, report_size, parse_options):
+    """
+    Run all log_analyzer stages in current process, returns wall and CPU time
+    of every stage and peak RSS of the process after it
+    """
+
+    stages = {}
+
+    def measure(stage, func, *args, **kwargs):
+        wall, cpu = time.perf_counter(), time.process_time()
+        result = func(*args, **kwargs)
+        stages[stage] = {"wall_sec": time.perf_counter() - wall,
+                         "cpu_sec": time.process_time() - cpu,
+                         "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+        return result
+
+    log_file_name, date = measure("find_last_log_file", log_analyzer.find_last_log_file,
+                                  log_analyzer.NGINX_FILE_NAME_PATTERN, log_dir)
+    info, url_stats = measure("parse_log_file", log_analyzer.parse_log_file, log_analyzer.UI_SHORT_PATTERN,
+                              os.path.join(log_dir, log_file_name), **parse_options)
+    report = measure("prepare_report", log_analyzer.prepare_report, url_stats, info, report_size)
+    measure("write_report_to_html", log_analyzer.write_report_to_html, report,
+            os.path.join(os.path.dirname(os.path.abspath(log_analyzer.__file__)), "report.html"),
+            os.path.join(report_dir, "report-{:%Y.%m.%d}.html".format(date)))
+
+    stages["parse_log_file"].update(lines=info["total"], succeed=info["succeed"], urls=len(url_stats))
+    return stages
+
+
+def benchmark_stages(size, compress=False, extra_files=1000, report_size=1000, parse_options=None,
+                     **generate_options):
+    """
+    Generate log directory and time every log_analyzer stage in fresh process,
+    returns stage measurements with lines/sec and MB/sec of parsing
+    """
+
+    with tempfile.TemporaryDirectory() as log_dir:
+        report_dir = os.path.join(log_dir, "reports")
+        os.mkdir(report_dir)
+        file_name, lines, size = generate_log_dir(log_dir, size, compress, extra_files, **generate_options)
+        file_size = os.path.getsize(file_name)
+
+        with multiprocessing.get_context("spawn").Pool(1, maxtasksperchild=1) as pool:
+            stages = pool.apply(measure_stages, (log_dir, report_dir, report_size, parse_options or {}))
+
+    parse = stages["parse_log_file"]
+    parse.update(file_mb=file_size / 1024 / 1024,
+                 uncompressed_mb=size / 1024 / 1024,
+                 lines_per_sec=lines / parse["wall_sec"],
+                 mb_per_sec=size / 1024 / 1024 / parse["wall_sec"])
+    for stage in STAGES:
+        print("{:>22}: {:8.3f}s wall, {:8.3f}s CPU, peak RSS {:.0f} MB"
+              .format(stage, stages[stage]["wall_sec"], stages[stage]["cpu_sec"], stages[stage]["peak_rss_mb"]))
+    print("{:>22}  {:.0f} lines/s, {:.1f} MB/s".format("", parse["lines_per_sec"], parse["mb_per_sec"]))
+
+    return stages
+
+
+def generate_url_stats(urls_count, requests_count, seed=46):
+    """Generate urls request times with heavy-tailed distribution of requests between urls"""
+
+    generator = random.Random(seed)
+    url_stats = {"/api/v2/banner/{}".format(i): [round(generator.expovariate(5), 3)] for i in range(urls_count)}
+    urls = list(url_stats)
+    for _ in range(max(0, requests_count - urls_count)):
+        url_stats[urls[min(int(generator.paretovariate(1)) - 1, urls_count - 1)]].append(
+            round(generator.expovariate(5), 3))
+    return url_stats
+
+
+def measure_parse(file_name, use_mmap):
+    """Parse log file in current process, returns parse time, lines count and peak RSS in MB"""
+
+    started = time.perf_counter()
+    info, _ = log_analyzer.parse_log_file(log_analyzer.UI_SHORT_PATTERN, file_name, use_mmap=use_mmap,
+                                          tokenizer=log_analyzer.tokenize_ui_short,
+                                          quantile_error=0.01)
+    elapsed = time.perf_counter() - started
+    return elapsed, info["total"], resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def benchmark_readers(size, **generate_options):
+    """Compare buffered and mmap readers of plain log, every reader runs in fresh process"""
+
+    results = []
+    with tempfile.TemporaryDirectory() as log_dir:
+        file_name = os.path.join(log_dir, "benchmark.log")
+        _, size = generate_log(file_name, size, **generate_options)
+        size_mb = size / 1024 / 1024
+        with multiprocessing.get_context("spawn").Pool(1, maxtasksperchild=1) as pool:
+            for reader, use_mmap in (("buffered", False), ("mmap", True)):
+                elapsed, lines, peak_rss = pool.apply(measure_parse, (file_name, use_mmap))
+                results.append({"reader": reader, "sec": elapsed, "lines_per_sec": lines / elapsed,
+                                "mb_per_sec": size_mb / elapsed, "peak_rss_mb": peak_rss})
+                print("{:>8}: {:.1f}s, {:.0f} lines/s, {:.1f} MB/s, peak RSS {:.0f} MB"
+                      .format(reader, elapsed, lines / elapsed, size_mb / elapsed, peak_rss))
+
+    return results
+
+
+def prepare_report_full_sort(url_stats, info, report_size):
+    """Statistics for every url and sort of the whole table, as prepare_report did before top-K selection"""
+
+    all_urls_stats = [log_analyzer.get_stats(url, request_times, info["succeed"], info["total_time"])
+                      for url, request_times in url_stats.items()]
+    return sorted(all_urls_stats, key=lambda report: report["time_sum"], reverse=True)[:report_size]
+
+
+def benchmark_prepare_report(urls_counts, report_size=1000, repeat=3):
+    """Compare top-K prepare_report with full sort on growing number of urls"""
+
+    results = []
+    for urls_count in urls_counts:
+        url_stats = generate_url_stats(urls_count, urls_count * 3)
+        info = {"succeed": sum(map(len, url_stats.values())),
+                "total_time": log_analyzer.total_request_time(url_stats)}
+        assert (log_analyzer.prepare_report(url_stats, info, report_size)
+                == prepare_report_full_sort(url_stats, info, report_size))
+
+        full_sort = min(timeit.repeat(lambda: prepare_report_full_sort(url_stats, info, report_size),
+                                      number=1, repeat=repeat))
+        top_k = min(timeit.repeat(lambda: log_analyzer.prepare_report(url_stats, info, report_size),
+                                  number=1, repeat=repeat))
+        results.append({"urls": urls_count, "full_sort_sec": full_sort, "top_k_sec": top_k,
+                        "speedup": full_sort / top_k})
+        print("{:>9} urls: full sort {:.3f}s, top-K {:.3f}s, speedup {:.1f}x"
+              .format(urls_count, full_sort, top_k, full_sort / top_k))
+
+    return results
+
+
+def compare_results(baseline, results, threshold):
+    """
+    Compare stage wall times with baseline results,
+    returns stages which are slower than baseline by more than threshold
+    """
+
+    regressions = []
+    if baseline["parameters"] != results["parameters"]:
+        print("Warning: baseline was measured with other parameters: {}".format(baseline["parameters"]))
+    for stage in STAGES:
+        before = baseline["stages"][stage]["wall_sec"]
+        after = results["stages"][stage]["wall_sec"]
+        change = after / before - 1 if before else 0
+        regression = change > threshold
+        if regression:
+            regressions.append(stage)
+        print("{:>22}: {:8.3f}s -> {:8.3f}s {:+7.1%}{}"
+              .format(stage, before, after, change, "  REGRESSION" if regression else ""))
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("--log-size", dest="log_size", default=50, type="int",
+                      help="size of generated log in MB before compression")
+    parser.add_option("--urls", dest="urls", default=10000, type="int", help="number of distinct urls in log")
+    parser.add_option("--error-ratio", dest="error_ratio", default=0.01, type="float",
+                      help="ratio of malformed lines in log")
+    parser.add_option("--gzip", dest="gzip", default=False, action="store_true", help="generate gzip log")
+    parser.add_option("--extra-files", dest="extra_files", default=1000, type="int",
+                      help="number of other files in log directory")
+    parser.add_option("--seed", dest="seed", default=46, type="int")
+    parser.add_option("--workers", dest="workers", default=1, type="int")
+    parser.add_option("--streaming", dest="streaming", default=False, action="store_true",
+                      help="streaming statistics mode")
+    parser.add_option("--report-size", dest="report_size", default=1000, type="int")
+    parser.add_option("--topk-urls", dest="topk_urls", default="", type="string",
+                      help="comma separated numbers of urls to compare top-K prepare_report with full sort")
+    parser.add_option("--readers", dest="readers", default=False, action="store_true",
+                      help="compare buffered and mmap readers of plain log")
+    parser.add_option("--output", dest="output", default=None, type="string", help="save results to json file")
+    parser.add_option("--compare", dest="compare", default=None, type="string",
+                      help="json file with baseline results")
+    parser.add_option("--threshold", dest="threshold", default=0.1, type="float",
+                      help="allowed slowdown of stage compared to baseline")
+    options, args = parser.parse_args()
+
+    generate_options = {"urls_count": options.urls, "error_ratio": options.error_ratio, "seed": options.seed}
+    parse_options = {"workers": options.workers,
+                     "tokenizer": log_analyzer.tokenize_ui_short,
+                     "quantile_error": 0.01 if options.streaming else None}
+    results = {
+        "environment": {"python": sys.version, "platform": platform.platform(), "cpus": os.cpu_count(),
+                        "time": datetime.datetime.now().isoformat()},
+        "parameters": {"log_size_mb": options.log_size, "gzip": options.gzip, "extra_files": options.extra_files,
+                       "workers": options.workers, "streaming": options.streaming,
+                       "report_size": options.report_size, **generate_options},
+        "stages": benchmark_stages(options.log_size * 1024 * 1024, options.gzip, options.extra_files,
+                                   options.report_size, parse_options, **generate_options)
+    }
+    if options.topk_urls:
+        results["prepare_report_top_k"] = benchmark_prepare_report(
+            [int(urls) for urls in options.topk_urls.split(",")], options.report_size)
+    if options.readers:
+        results["readers"] = benchmark_readers(options.log_size * 1024 * 1024, **generate_options)
+
+    if options.output:
+        with open(options.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            if compare_results(json.load(baseline_file), results, options.threshold):
+                sys.exit(1)
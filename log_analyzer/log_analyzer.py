@@ -1,29 +1,151 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import ast
+import bz2
+import cProfile
 import datetime
+import glob
 import gzip
+import hashlib
+import heapq
 import json
 import logging
+import math
+import mmap
+import multiprocessing
 import optparse
 import os
+import queue
 import re
+import shutil
+import subprocess
 import sys
+import threading
 
-from statistics import median
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from itertools import chain
+from statistics import NormalDist, median
 from string import Template
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, TemporaryFile
+from time import perf_counter, process_time, sleep, time_ns
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    from deco import timed, timings_report
+except ImportError:
+    timed = None
 
 # log_format ui_short '$remote_addr  $remote_user $http_x_real_ip [$time_local] "$request" '
 #                     '$status $body_bytes_sent "$http_referer" '
 #                     '"$http_user_agent" "$http_x_forwarded_for" "$http_X_REQUEST_ID" "$http_X_RB_USER" '
 #                     '$request_time';
+# two spaces are written after $remote_user in ui_short logs
+UI_SHORT_LOG_FORMAT = '$remote_addr $remote_user  $http_x_real_ip [$time_local] "$request" ' \
+                      '$status $body_bytes_sent "$http_referer" ' \
+                      '"$http_user_agent" "$http_x_forwarded_for" "$http_X_REQUEST_ID" "$http_X_RB_USER" ' \
+                      '$request_time'
+
+UI_SHORT_PATTERN = re.compile(
+    "(?P<remote_addr>.+)\s+(?P<remote_user>.+)\s+(?P<http_x_real_ip>.+)\s+\[(?P<time_local>.+)\]\s+" \
+    "\"[A-Z]{1,} (?P<request>.+) .*\"\s+(?P<status>.+)\s+(?P<body_bytes_send>.+)\s+" \
+    "\"(?P<http_referer>.+)\"\s+\"(?P<http_user_agent>.+)\"\s+\"(?P<http_x_forwarded_for>.+)\"\s+" \
+    "\"(?P<http_X_REQUEST_ID>.+)\"\s+\"(?P<http_X_RB_USER>.+)\"\s+(?P<request_time>.+)")
+
+NGINX_FILE_NAME_PATTERN = re.compile(".*nginx-access-ui\.log-(?P<date>\d{8})(\.gz|\.bz2|\.zst)?$")
+
+PRINTABLE_ASCII = bytes(range(0x20, 0x7f))
+
+# variable of nginx log_format: $name or ${name}
+LOG_FORMAT_VARIABLE = re.compile(r"\$(?:(\w+)|\{(\w+)\})")
+
+TABLE_JSON_PLACEHOLDER = re.compile(r"\$(?:table_json\b|\{table_json\})")
+
+# urls come from log, escaped json can't close script tag of report
+HTML_JSON_ESCAPES = str.maketrans({"<": "\\u003c", ">": "\\u003e", "&": "\\u0026"})
+
+OTHER_URLS = "(other)"
+
+COMPRESSED_EXTENSIONS = (".gz", ".bz2", ".zst")
+
+# single threaded gzip and bzip2 tools are not faster than standard library in background thread
+EXTERNAL_DECOMPRESSORS = {
+    ".gz": [["pigz", "-dc"]],
+    ".bz2": [["lbzip2", "-dc"], ["pbzip2", "-dc"]],
+    ".zst": [["zstd", "-dcq"]],
+}
+
+READ_BLOCK_SIZE = 4 * 1024 * 1024
+MMAP_RELEASE_SIZE = 16 * 1024 * 1024
+FINGERPRINT_SIZE = 4096
+
+# seconds, coarse enough for directory modification time of network file systems
+LOG_INDEX_MTIME_GRANULARITY = 2
+
+# exported columns of parsed lines and their array typecodes,
+# url column keeps indexes in per chunk list of urls
+EXPORT_COLUMNS = {
+    "time_local": "q",
+    "url": "I",
+    "status": "H",
+    "body_bytes_send": "q",
+    "request_time": "d",
+}
+EXPORT_CHUNK_LINES = 1000000
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+NPY_TYPES = {"q": "<i8", "I": "<u4", "H": "<u2", "d": "<f8"}
+# log_format variables of exported time_local, status and body_bytes_send columns
+EXPORT_VARIABLES = ("time_local", "status", "body_bytes_sent")
+
+# error rate is first tested after ERROR_RATE_MIN_LINES lines and then after every doubling of lines,
+# probability to abort parsing of log with acceptable error rate is not more than ERROR_RATE_ALPHA
+ERROR_RATE_MIN_LINES = 10000
+ERROR_RATE_ALPHA = 0.001
+# only first lines which cannot be parsed are logged, the rest are counted
+ERROR_LOG_LINES = 10
 
 config = {
     "REPORT_SIZE": 1000,
     "REPORT_DIR": "./reports",
+    "REPORT_TEMPLATE": "./report.html",
     "LOG_DIR": "./log",
+    "LOG_INDEX": "",
+    "LOG_FORMAT": UI_SHORT_LOG_FORMAT,
     "ERROR_RATE": 0.1,
+    "WORKERS": 1,
+    "STREAMING_STATS": False,
+    "QUANTILE_ERROR": 0.01,
+    "INCREMENTAL_LOG": "nginx-access-ui.log",
+    "AGGREGATE_DIR": "./aggregates",
+    "DAILY_AGGREGATES": False,
+    "URL_REWRITE_RULES": [],
+    "STRIP_QUERY": False,
+    "MAX_URLS": 0,
+    "DECOMPRESSOR": "external",
+    "MMAP": False,
+    "EXPORT_DIR": "",
+    "BATCH_WORKERS": 0,
+    "WATCH_INTERVAL": 60,
+    "METRICS": True,
+    "PROFILE": False,
     "LOG_NAME": "log_analyzer.log"
 }
 
@@ -37,153 +159,1898 @@ def update_config(config_file_name, config_):
     config_.update(config_from_file)
 
 
-def find_last_log_file(pattern, log_dir="."):
+def parse_log_date(text):
+    """Parse YYYYMMDD date of log file name, returns None if date is invalid"""
+
+    try:
+        return datetime.date(int(text[:4]), int(text[4:6]), int(text[6:8]))
+    except ValueError:
+        return None
+
+
+def scan_log_files(pattern, log_dir="."):
+    """
+    Find files matching regexp pattern in log_dir,
+    returns list of file_name and it's timestamp sorted by timestamp and name
+    """
+
+    pattern = re.compile(pattern)
+    log_files = []
+    with os.scandir(log_dir) as entries:
+        for entry in entries:
+            match = pattern.match(entry.name)
+            if match:
+                date = parse_log_date(match.group("date"))
+                if date is not None:
+                    log_files.append((entry.name, date))
+
+    return sorted(log_files, key=lambda log_file: (log_file[1], log_file[0]))
+
+
+def load_log_index(index_file_name, pattern, log_dir):
+    """
+    Load list of log files from index if log directory
+    was not changed since the index was saved, otherwise returns None
+    """
+
+    try:
+        with open(index_file_name, encoding="utf-8") as index_file:
+            index = json.load(index_file)
+    except (IOError, ValueError):
+        return None
+
+    # directory modification time changes when files are added, removed or renamed,
+    # changes within timestamp granularity after the scan may be missed
+    if (index.get("log_dir") != os.path.abspath(log_dir)
+            or index.get("pattern") != re.compile(pattern).pattern
+            or index.get("mtime_ns") != os.stat(log_dir).st_mtime_ns
+            or index.get("scanned_ns", 0) - index["mtime_ns"] < LOG_INDEX_MTIME_GRANULARITY * 10 ** 9):
+        return None
+
+    return [(file_name, parse_log_date(date)) for file_name, date in index["log_files"]]
+
+
+def save_log_index(index_file_name, pattern, log_dir, mtime_ns, scanned_ns, log_files):
+    """Atomically save list of log files found in log directory with its modification time"""
+
+    index = {"log_dir": os.path.abspath(log_dir),
+             "pattern": re.compile(pattern).pattern,
+             "mtime_ns": mtime_ns,
+             "scanned_ns": scanned_ns,
+             "log_files": [(file_name, "{:04d}{:02d}{:02d}".format(date.year, date.month, date.day))
+                           for file_name, date in log_files]}
+    with NamedTemporaryFile(mode="w", encoding="utf-8", dir=os.path.dirname(index_file_name) or ".",
+                            delete=False) as temp_index_file:
+        json.dump(index, temp_index_file)
+    os.replace(temp_index_file.name, index_file_name)
+
+
+def list_log_files(pattern, log_dir=".", index_file_name=None):
+    """
+    Find files matching regexp pattern in log_dir, returns list of file_name
+    and it's timestamp sorted by timestamp and name.
+    If index_file_name is given the list is kept in it and log directory
+    is scanned again only when it is changed
+    """
+
+    if not index_file_name:
+        return scan_log_files(pattern, log_dir)
+
+    log_files = load_log_index(index_file_name, pattern, log_dir)
+    if log_files is None:
+        mtime_ns = os.stat(log_dir).st_mtime_ns
+        log_files = scan_log_files(pattern, log_dir)
+        save_log_index(index_file_name, pattern, log_dir, mtime_ns, time_ns(), log_files)
+
+    return log_files
+
+
+def find_last_log_file(pattern, log_dir=".", index_file_name=None):
     """
     Find matching regexp pattern file with last timestamp,
-    returns file_name and it's timestamp string
+    returns file_name and it's timestamp.
+    If there are several files for the last date the first one in name order is used.
+    Index of log files is described in list_log_files
     """
 
-    log_file_name = str()
-    last_date = datetime.date(datetime.MINYEAR, 1, 1)
-    for file_name in os.listdir(log_dir):
-        match = re.match(pattern, file_name)
-        if match:
-            date = datetime.datetime.strptime(match.group("date"), "%Y%m%d").date()
-            if date > last_date:
-                last_date = date
-                log_file_name = file_name
+    log_files = list_log_files(pattern, log_dir, index_file_name)
+    if not log_files:
+        return None
 
-    return None if not log_file_name else (log_file_name, last_date)
+    return log_files[bisect_left(log_files, log_files[-1][1], key=lambda log_file: log_file[1])]
 
 
-def parse_log_file(pattern, file_name):
+def find_log_files(pattern, log_dir=".", date_from=None, date_to=None, index_file_name=None):
     """
-    Parse log file with given log pattern,
-    return dictionary with urls and request times
-    and dictionary with total log file statistics
+    Find matching regexp pattern files with timestamps from date_from to date_to
+    inclusive, returns list of file_name and it's timestamp sorted by timestamp.
+    If there are several files for one date the first one in name order is used.
+    Index of log files is described in list_log_files
+    """
+
+    log_files = list_log_files(pattern, log_dir, index_file_name)
+    first = 0 if date_from is None else bisect_left(log_files, date_from, key=lambda log_file: log_file[1])
+    last = len(log_files) if date_to is None else bisect_right(log_files, date_to, key=lambda log_file: log_file[1])
+
+    return [log_file for i, log_file in enumerate(log_files[first:last], first)
+            if i == first or log_files[i - 1][1] != log_file[1]]
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch with relative error guarantee (DDSketch).
+    Values are counted in logarithmic buckets, any quantile estimate
+    differs from the exact value by no more than relative_error of it.
+    Number of buckets depends on values range only, not on values count
+    """
+
+    __slots__ = ("relative_error", "gamma", "log_gamma", "zero_count", "count", "buckets")
+
+    def __init__(self, relative_error=0.01):
+        self.relative_error = relative_error
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+        self.log_gamma = math.log(self.gamma)
+        self.zero_count = 0
+        self.count = 0
+        self.buckets = {}
+
+    def add(self, value):
+        self.count += 1
+        if value <= 0:
+            self.zero_count += 1
+        else:
+            index = math.ceil(math.log(value) / self.log_gamma)
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other):
+        if other.relative_error != self.relative_error:
+            raise ValueError("Cannot merge sketches with different relative error")
+        self.count += other.count
+        self.zero_count += other.zero_count
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def quantiles(self, qs):
+        """Estimate values of ascending quantiles qs in one pass over buckets"""
+
+        result = []
+        if not self.count:
+            return [None] * len(qs)
+        qs = iter(qs)
+        q = next(qs, None)
+        seen = self.zero_count
+        while q is not None and q * (self.count - 1) < seen:
+            result.append(0.0)
+            q = next(qs, None)
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            while q is not None and q * (self.count - 1) < seen:
+                result.append(2 * self.gamma ** index / (self.gamma + 1))
+                q = next(qs, None)
+        return result
+
+    def quantile(self, q):
+        return self.quantiles([q])[0]
+
+    def to_dict(self):
+        return {"relative_error": self.relative_error,
+                "zero_count": self.zero_count,
+                "buckets": [[index, count] for index, count in self.buckets.items()]}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["relative_error"])
+        sketch.zero_count = data["zero_count"]
+        sketch.buckets = {index: count for index, count in data["buckets"]}
+        sketch.count = sketch.zero_count + sum(sketch.buckets.values())
+        return sketch
+
+
+class RequestTimes:
+    """
+    Streaming statistics of url request times: exact count, sum and max
+    and quantile sketch instead of list with every request time
+    """
+
+    __slots__ = ("count", "time_sum", "time_max", "sketch")
+
+    def __init__(self, relative_error=0.01):
+        self.count = 0
+        self.time_sum = 0.0
+        self.time_max = 0.0
+        self.sketch = QuantileSketch(relative_error)
+
+    def append(self, time):
+        self.count += 1
+        self.time_sum += time
+        if time > self.time_max:
+            self.time_max = time
+        self.sketch.add(time)
+
+    def merge(self, other):
+        self.count += other.count
+        self.time_sum += other.time_sum
+        self.time_max = max(self.time_max, other.time_max)
+        self.sketch.merge(other.sketch)
+
+    def quantiles(self, qs):
+        """Estimate ascending quantiles, estimates never exceed max request time"""
+
+        return [min(value, self.time_max) for value in self.sketch.quantiles(qs)]
+
+    def to_dict(self):
+        return {"count": self.count, "time_sum": self.time_sum, "time_max": self.time_max,
+                "sketch": self.sketch.to_dict()}
+
+    @classmethod
+    def from_dict(cls, data):
+        request_times = cls.__new__(cls)
+        request_times.count = data["count"]
+        request_times.time_sum = data["time_sum"]
+        request_times.time_max = data["time_max"]
+        request_times.sketch = QuantileSketch.from_dict(data["sketch"])
+        return request_times
+
+
+class ExternalDecompressorReader:
+    """
+    Read compressed file through external decompression tool
+    (pigz, lbzip2, zstd) running in separate process
+    """
+
+    def __init__(self, command, file_name):
+        self.stderr = TemporaryFile()
+        self.process = subprocess.Popen(command + [file_name], stdout=subprocess.PIPE, stderr=self.stderr)
+        self.finished = False
+
+    def read(self, size=-1):
+        data = self.process.stdout.read(size)
+        if not data:
+            self.finished = True
+        return data
+
+    def close(self):
+        self.process.stdout.close()
+        if not self.finished:
+            self.process.kill()
+        returncode = self.process.wait()
+        self.stderr.seek(0)
+        error = self.stderr.read().decode("utf-8", "replace").strip()
+        self.stderr.close()
+        if self.finished and returncode:
+            raise IOError("{} failed with code {}: {}".format(self.process.args[0], returncode, error))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ThreadedReader:
+    """
+    Read blocks of file in background thread, so decompression,
+    which releases GIL, overlaps with parsing in main thread
+    """
+
+    def __init__(self, log_file, block_size=READ_BLOCK_SIZE, prefetch=4):
+        self.log_file = log_file
+        self.block_size = block_size
+        self.blocks = queue.Queue(prefetch)
+        self.buffer = b""
+        self.eof = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.read_ahead, daemon=True)
+        self.thread.start()
+
+    def read_ahead(self):
+        try:
+            while not self.stopped.is_set():
+                block = self.log_file.read(self.block_size)
+                self.put(block)
+                if not block:
+                    break
+        except Exception as e:
+            self.put(e)
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            block = self.blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                self.eof = True
+            elif self.buffer:
+                self.buffer += block
+            else:
+                self.buffer = block
+
+        if size < 0 or len(self.buffer) <= size:
+            data, self.buffer = self.buffer, b""
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.log_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def is_compressed(file_name):
+    return file_name.endswith(COMPRESSED_EXTENSIONS)
+
+
+def open_log_file(file_name, decompressor="python"):
+    """
+    Open log file for binary reading. Compressed file is decompressed:
+    "python" -- with standard library in current thread,
+    "thread" -- with standard library in background thread,
+    "external" -- with external tool (pigz, lbzip2, pbzip2, zstd) in separate process,
+    if there is no such tool falls back to "thread".
+    Zstd file is decompressed with zstandard package if it is installed
+    and with external tool otherwise
+    """
+
+    extension = os.path.splitext(file_name)[1]
+    if extension not in COMPRESSED_EXTENSIONS:
+        return open(file_name, "rb")
+
+    # there is no zstd in standard library, zstandard package is optional
+    no_python_decompressor = extension == ".zst" and zstandard is None
+    if decompressor == "external" or no_python_decompressor:
+        for command in EXTERNAL_DECOMPRESSORS[extension]:
+            if shutil.which(command[0]):
+                return ExternalDecompressorReader(command, file_name)
+        if no_python_decompressor:
+            raise IOError("Cannot decompress {}: neither zstd tool nor zstandard package found".format(file_name))
+        decompressor = "thread"
+
+    if extension == ".gz":
+        log_file = gzip.open(file_name, "rb")
+    elif extension == ".bz2":
+        log_file = bz2.open(file_name, "rb")
+    else:
+        log_file = zstandard.ZstdDecompressor().stream_reader(open(file_name, "rb"), closefd=True)
+
+    return ThreadedReader(log_file) if decompressor == "thread" else log_file
+
+
+def iter_lines(blocks):
+    """
+    Split iterable of raw data blocks into lines,
+    lines are yielded without line separator
+    """
+
+    tail = b""
+    for block in blocks:
+        lines = (tail + block).split(b"\n")
+        tail = lines.pop()
+        yield from lines
+    if tail:
+        yield tail
+
+
+def read_blocks(log_file, start=0, end=None, block_size=READ_BLOCK_SIZE):
+    """Read opened binary file by blocks from start to end offset"""
+
+    if start:
+        log_file.seek(start)
+    left = end - start if end is not None else None
+    while left is None or left > 0:
+        block = log_file.read(block_size if left is None else min(block_size, left))
+        if not block:
+            break
+        if left is not None:
+            left -= len(block)
+        yield block
+
+
+def read_line_aligned_blocks(log_file, block_size=READ_BLOCK_SIZE):
+    """Read opened binary file by blocks which end on line boundary"""
+
+    tail = b""
+    for block in read_blocks(log_file, block_size=block_size):
+        block = tail + block
+        last_line_end = block.rfind(b"\n") + 1
+        tail = block[last_line_end:]
+        if last_line_end:
+            yield block[:last_line_end]
+    if tail:
+        yield tail
+
+
+def iter_mmap_lines(file_name, start=0, end=None, release_size=MMAP_RELEASE_SIZE):
+    """
+    Iterate lines of plain file from start to end offset, lines
+    are sliced directly from memory mapped file without intermediate
+    read buffers. Pages which are already parsed are released
+    every release_size bytes, so resident memory doesn't grow with file size
+    """
+
+    with open(file_name, "rb") as log_file:
+        size = os.fstat(log_file.fileno()).st_size if end is None else end
+        if size <= start:
+            return
+        with mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            find = mapped.find
+            position = start
+            released = start - start % mmap.PAGESIZE
+            while position < size:
+                line_end = find(b"\n", position, size)
+                if line_end == -1:
+                    line_end = size
+                yield mapped[position:line_end]
+                position = line_end + 1
+                if position - released >= release_size and hasattr(mapped, "madvise"):
+                    boundary = position - position % mmap.PAGESIZE
+                    mapped.madvise(mmap.MADV_DONTNEED, released, boundary - released)
+                    released = boundary
+
+
+def split_log_file(file_name, parts, start=0, end=None):
+    """
+    Split plain log file or its part from start to end offset
+    into byte ranges aligned on line boundaries,
+    returns list of (start, end) offsets
+    """
+
+    size = os.path.getsize(file_name) if end is None else end
+    bounds = [start]
+    with open(file_name, "rb") as log_file:
+        for part in range(1, parts):
+            position = start + (size - start) * part // parts
+            if position <= bounds[-1]:
+                continue
+            log_file.seek(position - 1)
+            log_file.readline()
+            position = log_file.tell()
+            if position >= size:
+                break
+            bounds.append(position)
+    bounds.append(size)
+
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def total_request_time(url_stats):
+    """
+    Calculate total request time of all urls,
+    for request times lists the result doesn't depend
+    on the order in which lines were parsed
+    """
+
+    if url_stats and isinstance(next(iter(url_stats.values())), RequestTimes):
+        return math.fsum(request_times.time_sum for request_times in url_stats.values())
+    return math.fsum(chain.from_iterable(url_stats.values()))
+
+
+def is_ui_short_prefix(prefix):
+    """
+    Check that part of ui_short line before request matches remote_addr,
+    remote_user, http_x_real_ip and time_local fields of UI_SHORT_PATTERN,
+    lines with more than one pair of square brackets are rejected
+    """
+
+    if prefix.count(b"[") != 1 or prefix.count(b"]") != 1:
+        return False
+    time_end = prefix.find(b"]")
+    time_start = prefix.find(b"[")
+    if time_end - time_start < 2 or prefix[time_end + 1:].strip(b" ") or time_end + 1 == len(prefix):
+        return False
+    head = prefix[:time_start]
+    if not head.endswith(b" "):
+        return False
+    head = head.rstrip(b" ")
+    first_space = head.find(b" ", 1)
+    return first_space != -1 and head.find(b" ", first_space + 2) != -1
+
+
+def tokenize_ui_short(line):
+    """
+    Extract request and request time from raw ui_short log line
+    without regex and decoding of the whole line.
+    Returns None for every line which structure is not exactly
+    the one of ui_short format, such lines are left for regex.
+    For accepted lines the result is the same as with UI_SHORT_PATTERN
+    """
+
+    fields = line.split(b'"')
+    if len(fields) != 13 or line.translate(None, PRINTABLE_ASCII):
+        return None
+
+    # fields between quotes: request, referer, user agent, forwarded for, request id, rb user
+    if not (fields[3] and fields[5] and fields[7] and fields[9] and fields[11]):
+        return None
+    for separator in fields[4], fields[6], fields[8], fields[10]:
+        if not separator or separator.strip(b" "):
+            return None
+    # status and body bytes sent
+    if not fields[2].startswith(b" ") or not fields[2].endswith(b" ") or b" " not in fields[2].strip(b" "):
+        return None
+    if not fields[12].startswith(b" ") or not is_ui_short_prefix(fields[0]):
+        return None
+
+    request = fields[1]
+    method_end = request.find(b" ")
+    url_end = request.rfind(b" ")
+    if method_end < 1 or url_end - method_end < 2:
+        return None
+    method = request[:method_end]
+    if not method.isalpha() or not method.isupper():
+        return None
+
+    try:
+        request_time = float(fields[12].lstrip(b" "))
+    except ValueError:
+        return None
+
+    return request[method_end + 1:url_end].decode("utf-8"), request_time
+
+
+def parse_log_format(log_format):
+    """
+    Split nginx log_format into literals and names of variables,
+    literals list is one item longer than variables list
+    """
+
+    literals = []
+    variables = []
+    position = 0
+    for match in LOG_FORMAT_VARIABLE.finditer(log_format):
+        literals.append(log_format[position:match.start()])
+        variables.append(match.group(1) or match.group(2))
+        position = match.end()
+    literals.append(log_format[position:])
+
+    return literals, variables
+
+
+@lru_cache(maxsize=None)
+def compile_log_format(log_format, variables):
+    """
+    Generate extractor of variables of nginx log_format from raw log line.
+    Extractor returns tuple of bytes values of variables, or None if some
+    literal of log format is not found in the line. Line is scanned from
+    left to right with find of literals between variables, only requested
+    variables are sliced and scanning stops after the last of them.
+    Extractors are cached by log format and variables
+    """
+
+    literals, format_variables = parse_log_format(log_format)
+    missing = sorted(set(variables) - set(format_variables))
+    if missing:
+        raise ValueError("Log format has no variables: {}".format(", ".join(missing)))
+    for variable, literal in zip(format_variables[1:], literals[1:-1]):
+        if not literal:
+            raise ValueError("Variable ${} is not separated from previous variable".format(variable))
+
+    first_literal = literals[0].encode("utf-8")
+    code = ["def extract(line):"]
+    if first_literal:
+        code += ["    if not line.startswith({!r}):".format(first_literal),
+                 "        return None"]
+    code.append("    start = {}".format(len(first_literal)))
+
+    values = {}
+    last = max(format_variables.index(variable) for variable in variables)
+    for i, variable in enumerate(format_variables[:last + 1]):
+        literal = literals[i + 1].encode("utf-8")
+        value = "value{}".format(i)
+        if not literal:
+            code.append("    {} = line[start:]".format(value))
+        else:
+            code += ["    end = line.find({!r}, start)".format(literal),
+                     "    if end < 0:",
+                     "        return None"]
+            if variable in variables and variable not in values:
+                code.append("    {} = line[start:end]".format(value))
+            code.append("    start = end + {}".format(len(literal)))
+        values.setdefault(variable, value)
+    code.append("    return {},".format(", ".join(values[variable] for variable in variables)))
+
+    namespace = {}
+    exec("\n".join(code), namespace)
+    return namespace["extract"]
+
+
+class LogFormat:
+    """
+    Tokenizer of lines of nginx log_format, e.g.
+    LogFormat('$remote_addr [$time_local] "$request" $status $request_time'),
+    extracts url and request time from raw line with extractor generated
+    by compile_log_format. Lines which request is not "METHOD url protocol"
+    are rejected. Only log format is pickled, worker processes
+    take extractors from their own cache
+    """
+
+    def __init__(self, log_format):
+        self.log_format = log_format
+        self.extract = compile_log_format(log_format, ("request", "request_time"))
+        variables = parse_log_format(log_format)[1]
+        self.export_variables = tuple(variable for variable in EXPORT_VARIABLES if variable in variables)
+        self.extract_export = compile_log_format(log_format, self.export_variables) if self.export_variables else None
+
+    def __reduce__(self):
+        return LogFormat, (self.log_format,)
+
+    def __call__(self, line):
+        fields = self.extract(line)
+        if fields is None:
+            return None
+
+        request, request_time = fields
+        method_end = request.find(b" ")
+        url_end = request.rfind(b" ")
+        if method_end < 1 or url_end - method_end < 2:
+            return None
+        method = request[:method_end]
+        if not method.isalpha() or not method.isupper():
+            return None
+
+        try:
+            return request[method_end + 1:url_end].decode("utf-8"), float(request_time)
+        except (UnicodeDecodeError, ValueError):
+            return None
+
+    def export_fields(self, line):
+        """time_local, status and body_bytes_sent of raw line, missing variables are empty"""
+
+        values = dict(zip(self.export_variables, self.extract_export(line) or ())) if self.extract_export else {}
+        return tuple(values.get(variable, b"") for variable in EXPORT_VARIABLES)
+
+
+def log_format_pattern(log_format):
+    """
+    Regex for lines rejected by log_format_tokenizer: original UI_SHORT_PATTERN
+    for ui_short format, None for other formats
+    """
+
+    return UI_SHORT_PATTERN if log_format == UI_SHORT_LOG_FORMAT else None
+
+
+def log_format_tokenizer(log_format):
+    """
+    Tokenizer of log lines of log_format: tokenize_ui_short for ui_short format,
+    so that results are the same as with UI_SHORT_PATTERN, LogFormat for other formats
+    """
+
+    return tokenize_ui_short if log_format == UI_SHORT_LOG_FORMAT else LogFormat(log_format)
+
+
+class UrlNormalizer:
+    """
+    Collapse urls with ids into one url: strip query string
+    and rewrite url with regexp rules, e.g.
+    UrlNormalizer([["/\\d+(?=/|$)", "/{id}"]]) turns /api/v2/banner/123 into /api/v2/banner/{id}
     """
 
-    open_log = gzip.open if file_name.endswith(".gz") else open
+    def __init__(self, rules=(), strip_query=False):
+        self.rules = [(re.compile(pattern), replacement) for pattern, replacement in rules]
+        self.strip_query = strip_query
+
+    def __call__(self, url):
+        if self.strip_query:
+            url = url.partition("?")[0]
+        for pattern, replacement in self.rules:
+            url = pattern.sub(replacement, url)
+        return url
+
+
+def save_npy(file_name, values):
+    """Save array as one-dimensional array in NumPy .npy format"""
+
+    header = "{{'descr': '{}', 'fortran_order': False, 'shape': ({},), }}".format(NPY_TYPES[values.typecode],
+                                                                              len(values))
+    # header is padded so that data is 64 bytes aligned
+    header += " " * (-(len(NPY_MAGIC) + 2 + len(header) + 1) % 64) + "\n"
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    with open(file_name, "wb") as npy_file:
+        npy_file.write(NPY_MAGIC + len(header).to_bytes(2, "little") + header.encode("latin1"))
+        values.tofile(npy_file)
+
+
+def load_npy(file_name, typecode):
+    """Load one-dimensional array saved by save_npy"""
+
+    with open(file_name, "rb") as npy_file:
+        if npy_file.read(len(NPY_MAGIC)) != NPY_MAGIC:
+            raise ValueError("{} is not .npy file of version 1.0".format(file_name))
+        header = ast.literal_eval(npy_file.read(int.from_bytes(npy_file.read(2), "little")).decode("latin1"))
+        if header["descr"] != NPY_TYPES[typecode] or header["fortran_order"] or len(header["shape"]) != 1:
+            raise ValueError("{} is not one-dimensional {} array".format(file_name, header["descr"]))
+        values = array(typecode)
+        values.frombytes(npy_file.read())
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def parse_time_local(time_local):
+    """Convert nginx time_local to unix timestamp, returns 0 if time can't be parsed"""
+
+    try:
+        return int(datetime.datetime.strptime(time_local, "%d/%b/%Y:%H:%M:%S %z").timestamp())
+    except ValueError:
+        return 0
+
+
+def ui_short_export_fields(line):
+    """time_local, status and body_bytes_sent of raw line accepted by tokenize_ui_short"""
+
+    prefix, _, status_fields = line.split(b'"', 3)[:3]
+    time_local = prefix[prefix.find(b"[") + 1:prefix.find(b"]")]
+    status, body_bytes_send = status_fields.rsplit(None, 1)
+    return time_local, status.strip(), body_bytes_send
+
+
+class ColumnWriter:
+    """
+    Write time_local, url, status, body_bytes_send and request_time of parsed log lines
+    into export_dir as columns, EXPORT_CHUNK_LINES lines per chunk.
+    Every column of chunk is .npy file, urls of chunk are saved in json file.
+    Chunk files names start with offset of the first line in log file,
+    so chunks of several writers of one log file are ordered by name.
+    Fields of lines parsed without regex are taken by export_fields
+    """
+
+    def __init__(self, export_dir, offset=0, chunk_lines=EXPORT_CHUNK_LINES, export_fields=None):
+        self.export_dir = export_dir
+        self.offset = offset
+        self.chunk_lines = chunk_lines
+        self.export_fields = export_fields or ui_short_export_fields
+        self.chunk = 0
+        self.last_time_local = None
+        self.last_timestamp = 0
+        self.start_chunk()
+
+    def start_chunk(self):
+        self.columns = {column: array(typecode) for column, typecode in EXPORT_COLUMNS.items()}
+        self.urls = {}
+
+    def append(self, line, match, url, request_time):
+        """
+        Add parsed line, time_local, status and body_bytes_send are taken
+        from regex match or from the raw line accepted by tokenizer
+        """
+
+        if match is not None:
+            time_local, status, body_bytes_send = match.group("time_local", "status", "body_bytes_send")
+        else:
+            time_local, status, body_bytes_send = self.export_fields(line)
+
+        # lines of one second share time_local, the most of lines don't need strptime
+        if time_local != self.last_time_local:
+            self.last_time_local = time_local
+            # raw lines are not checked by every tokenizer, time_local which is not ASCII is not parsed
+            self.last_timestamp = parse_time_local(time_local if match else time_local.decode("ascii", "replace"))
+
+        columns = self.columns
+        columns["time_local"].append(self.last_timestamp)
+        columns["url"].append(self.urls.setdefault(url, len(self.urls)))
+        columns["status"].append(int(status) if status.isascii() and status.isdigit() and len(status) < 5 else 0)
+        columns["body_bytes_send"].append(int(body_bytes_send)
+                                          if body_bytes_send.isascii() and body_bytes_send.isdigit() else -1)
+        columns["request_time"].append(request_time)
+        if len(columns["request_time"]) >= self.chunk_lines:
+            self.flush()
+
+    def flush(self):
+        """Save collected lines as a chunk"""
+
+        if not self.columns["request_time"]:
+            return
+        prefix = os.path.join(self.export_dir, "{:016d}-{:06d}".format(self.offset, self.chunk))
+        with open(prefix + "-urls.json", "w", encoding="utf-8") as urls_file:
+            json.dump(list(self.urls), urls_file)
+        for column, values in self.columns.items():
+            save_npy("{}-{}.npy".format(prefix, column), values)
+        self.chunk += 1
+        self.start_chunk()
+
+
+def load_columns(export_dir, columns=tuple(EXPORT_COLUMNS)):
+    """
+    Load exported columns of log lines in the order of the lines in log file,
+    returns dictionary with array for every column. Url column contains
+    indexes in list of urls which is returned under "urls" key
+    """
+
+    result = {column: array(EXPORT_COLUMNS[column]) for column in columns}
+    urls = {}
+    for chunk_file_name in sorted(glob.glob(os.path.join(glob.escape(export_dir), "*-urls.json"))):
+        prefix = chunk_file_name[:-len("-urls.json")]
+        for column in columns:
+            values = load_npy("{}-{}.npy".format(prefix, column), EXPORT_COLUMNS[column])
+            if column == "url":
+                with open(chunk_file_name, encoding="utf-8") as urls_file:
+                    url_ids = [urls.setdefault(url, len(urls)) for url in json.load(urls_file)]
+                values = array("I", [url_ids[url_id] for url_id in values])
+            result[column].extend(values)
+    if "url" in columns:
+        result["urls"] = list(urls)
+
+    return result
+
+
+class ErrorRateExceeded(Exception):
+    """Parsing is aborted because share of lines which cannot be parsed is above error rate"""
+
+    def __init__(self, total, errors):
+        super().__init__(total, errors)
+        self.total = total
+        self.errors = errors
+
+
+def is_error_rate_exceeded(total, errors, error_rate, alpha):
+    """
+    Check that share of errors in population is above error_rate
+    by one-sided Wilson score interval with significance alpha
+    """
+
+    z = NormalDist().inv_cdf(1 - alpha)
+    share = errors / total
+    lower_bound = ((share + z * z / (2 * total) - z * math.sqrt(share * (1 - share) / total + z * z / (4 * total ** 2)))
+                   / (1 + z * z / total))
+    return lower_bound > error_rate
+
+
+class ErrorRateTest:
+    """
+    Sequential test of error rate of log lines: error rate is tested after
+    ERROR_RATE_MIN_LINES lines and then after every doubling of lines with
+    halved significance, so that probability to abort parsing of lines
+    with acceptable error rate is not more than alpha
+    """
+
+    def __init__(self, error_rate, alpha=ERROR_RATE_ALPHA):
+        self.error_rate = error_rate
+        self.next_check = ERROR_RATE_MIN_LINES
+        self.alpha = alpha / 2
+
+    def check(self, total, errors):
+        """Raise ErrorRateExceeded if error rate of total lines tested so far is significantly above error_rate"""
+
+        if total < self.next_check:
+            return
+        if is_error_rate_exceeded(total, errors, self.error_rate, self.alpha):
+            raise ErrorRateExceeded(total, errors)
+        while self.next_check <= total:
+            self.next_check *= 2
+            self.alpha /= 2
+
+
+def parse_lines(pattern, lines, quantile_error=None, tokenizer=None, url_normalizer=None, max_urls=0,
+                error_rate=None, export_dir=None, export_offset=0, error_rate_alpha=ERROR_RATE_ALPHA):
+    """
+    Parse iterable of log lines with given log pattern,
+    return dictionary with total statistics
+    and dictionary with urls and request times.
+    Request times are stored in lists, or in streaming
+    RequestTimes with bounded memory if quantile_error is set.
+    Tokenizer extracts url and request time from raw line,
+    lines rejected by tokenizer are parsed with pattern if it is set.
+    Urls are normalized with url_normalizer, when there are
+    max_urls distinct urls all new urls are counted as OTHER_URLS.
+    ErrorRateExceeded is raised as soon as share of lines which
+    cannot be parsed is statistically significantly above error_rate,
+    see ErrorRateTest, error_rate_alpha is its significance.
+    Lines which are not valid UTF-8 cannot be parsed with pattern.
+    Fields of parsed lines are exported into export_dir by ColumnWriter,
+    export_offset is offset of the first line in log file
+    """
 
     total = 0
     succeed = 0
-    total_time = 0
     url_stats = {}
+    new_request_times = list if quantile_error is None else partial(RequestTimes, quantile_error)
+    error_rate_test = ErrorRateTest(error_rate, error_rate_alpha) if error_rate is not None else None
+    next_check = error_rate_test.next_check if error_rate_test else 0
+    column_writer = None
+    if export_dir:
+        export_fields = tokenizer.export_fields if isinstance(tokenizer, LogFormat) else None
+        column_writer = ColumnWriter(export_dir, export_offset, export_fields=export_fields)
 
-    print("{} log parsing started".format(file_name))
-    with open_log(file_name, "rb") as log_file:
-        for line in log_file:
-            total += 1
-            if total % 10000 == 0:
-                print("{} rows processed, {} are succeed".format(total, succeed))
-
-            line = line.decode("utf-8")
+    for line in lines:
+        total += 1
+        if total % 10000 == 0:
+            print("{} rows processed, {} are succeed".format(total, succeed))
 
-            match = re.match(pattern, line)
+        match = None
+        parsed = tokenizer(line) if tokenizer else None
+        if parsed is None and pattern is not None:
+            try:
+                line = line.decode("utf-8")
+            except UnicodeDecodeError:
+                pass
+            else:
+                match = re.match(pattern, line)
             if match:
-                url = match.group("request")
+                try:
+                    parsed = match.group("request"), float(match.group("request_time"))
+                except ValueError:
+                    pass
 
-                time = float(match.group("request_time"))
-                total_time += time
+        if parsed:
+            url, time = parsed
+            if column_writer:
+                column_writer.append(line, match, url, time)
+            if url_normalizer:
+                url = url_normalizer(url)
+            if url not in url_stats:
+                if max_urls and len(url_stats) >= max_urls:
+                    url = OTHER_URLS
                 if url not in url_stats:
-                    url_stats[url] = []
-                url_stats[url].append(time)
+                    url_stats[url] = new_request_times()
+            url_stats[url].append(time)
+
+            succeed += 1
+        elif total - succeed <= ERROR_LOG_LINES:
+            logging.info("Cannot parse line: {}".format(line))
+
+        if total == next_check:
+            error_rate_test.check(total, total - succeed)
+            next_check = error_rate_test.next_check
+
+    if total - succeed > ERROR_LOG_LINES:
+        logging.info("{} more lines cannot be parsed".format(total - succeed - ERROR_LOG_LINES))
+    if column_writer:
+        column_writer.flush()
+
+    info = {"total": total, "succeed": succeed, "total_time": total_request_time(url_stats)}
+
+    return info, url_stats
+
 
-                succeed += 1
+def merge_parse_results(results, max_urls=0):
+    """
+    Merge parse results of consecutive parts of log file,
+    urls request times keep the order of the lines in the file.
+    When there are max_urls distinct urls new urls are merged into OTHER_URLS
+    """
+
+    info = {"total": 0, "succeed": 0, "total_time": 0}
+    url_stats = {}
+    for part_info, part_url_stats in results:
+        info["total"] += part_info["total"]
+        info["succeed"] += part_info["succeed"]
+        for url, request_times in part_url_stats.items():
+            if url not in url_stats and max_urls and len(url_stats) >= max_urls:
+                url = OTHER_URLS
+            if url not in url_stats:
+                url_stats[url] = request_times
+            elif isinstance(request_times, RequestTimes):
+                url_stats[url].merge(request_times)
             else:
-                logging.info("Cannot parse line: {}".format(line))
+                url_stats[url].extend(request_times)
+    info["total_time"] = total_request_time(url_stats)
+
+    return info, url_stats
+
+
+def parse_file_range(pattern, file_name, start, end, use_mmap=False, **parse_options):
+    """Parse byte range of plain log file"""
+
+    if use_mmap:
+        return parse_lines(pattern, iter_mmap_lines(file_name, start, end), export_offset=start, **parse_options)
+    with open(file_name, "rb") as log_file:
+        return parse_lines(pattern, iter_lines(read_blocks(log_file, start, end)), export_offset=start,
+                           **parse_options)
+
+
+def parse_block(pattern, block, offset=0, **parse_options):
+    """Parse block of log lines, offset is offset of the block in log file"""
+
+    return parse_lines(pattern, iter_lines([block]), export_offset=offset, **parse_options)
+
+
+def parse_log_file_parallel(pattern, file_name, workers, block_size=READ_BLOCK_SIZE, start=0, end=None,
+                            decompressor="python", use_mmap=False, **parse_options):
+    """
+    Parse log file in worker processes.
+    Plain file or its part from start to end offset is split
+    into line aligned byte ranges, one per worker.
+    Compressed file is decompressed by current process and decompressed
+    blocks are sent to workers, no more than two blocks per worker at once.
+    Error rate of byte ranges is tested by workers, significance is split
+    between ranges. Error rate of blocks is tested by current process
+    on merged counts of parsed blocks.
+    Parse options are passed to parse_lines
+    """
+
+    with multiprocessing.Pool(workers) as pool:
+        if not is_compressed(file_name):
+            ranges = split_log_file(file_name, workers, start, end)
+            range_options = dict(parse_options, error_rate_alpha=ERROR_RATE_ALPHA / len(ranges))
+            return merge_parse_results(pool.starmap(partial(parse_file_range, use_mmap=use_mmap, **range_options),
+                                                    [(pattern, file_name, start, end) for start, end in ranges]),
+                                       parse_options.get("max_urls", 0))
+
+        error_rate = parse_options.get("error_rate")
+        error_rate_test = ErrorRateTest(error_rate) if error_rate is not None else None
+        block_options = dict(parse_options, error_rate=None)
+
+        def parse_blocks():
+            pending = deque()
+            offset = 0
+            total = errors = 0
+
+            def parsed(result):
+                nonlocal total, errors
+                if error_rate_test:
+                    total += result[0]["total"]
+                    errors += result[0]["total"] - result[0]["succeed"]
+                    error_rate_test.check(total, errors)
+                return result
+
+            with open_log_file(file_name, decompressor) as log_file:
+                for block in read_line_aligned_blocks(log_file, block_size):
+                    pending.append(pool.apply_async(parse_block, (pattern, block, offset), block_options))
+                    offset += len(block)
+                    if len(pending) >= 2 * workers:
+                        yield parsed(pending.popleft().get())
+            while pending:
+                yield parsed(pending.popleft().get())
+
+        return merge_parse_results(parse_blocks(), parse_options.get("max_urls", 0))
+
+
+def parse_log_file(pattern, file_name, error_rate=None, *, workers=1, start=0, end=None, decompressor="python",
+                   use_mmap=False, quantile_error=None, tokenizer=None, url_normalizer=None, max_urls=0,
+                   metrics=None, export_dir=None):
+    """
+    Parse log file with given log pattern,
+    return dictionary with total log file statistics
+    and dictionary with urls and request times.
+    Return None if share of lines which cannot be parsed is above error_rate,
+    parsing is aborted as soon as it is statistically significant.
+    With more than one worker file is parsed in parallel processes,
+    result is the same as with serial parsing
+    (with max_urls the same urls set may be counted as OTHER_URLS).
+    Only part of plain file from start to end offset may be parsed.
+    Plain file is read with mmap if use_mmap is set.
+    Parsed lines and read bytes are added to RunMetrics metrics if it is given.
+    Fields of parsed lines are exported to export_dir, see ColumnWriter,
+    previous export is removed when file is parsed from the beginning.
+    Decompressor is described in open_log_file, other options in parse_lines
+    """
+
+    parse_options = {"quantile_error": quantile_error, "tokenizer": tokenizer,
+                     "url_normalizer": url_normalizer, "max_urls": max_urls, "error_rate": error_rate}
+    if export_dir:
+        if not start:
+            shutil.rmtree(export_dir, ignore_errors=True)
+        os.makedirs(export_dir, exist_ok=True)
+        parse_options["export_dir"] = export_dir
+
+    print("{} log parsing started".format(file_name))
+    try:
+        if workers > 1:
+            result = parse_log_file_parallel(pattern, file_name, workers, start=start, end=end,
+                                             decompressor=decompressor, use_mmap=use_mmap, **parse_options)
+        elif use_mmap and not is_compressed(file_name):
+            result = parse_file_range(pattern, file_name, start, end, use_mmap=True, **parse_options)
+        else:
+            with open_log_file(file_name, decompressor) as log_file:
+                result = parse_lines(pattern, iter_lines(read_blocks(log_file, start, end)), export_offset=start,
+                                     **parse_options)
+    except ErrorRateExceeded as e:
+        logging.error("{} of first {} lines of {} cannot be parsed, error rate is above {}. Abort."
+                      .format(e.errors, e.total, file_name, error_rate))
+        if metrics is not None:
+            metrics.add({"total": e.total, "succeed": e.total - e.errors}, 0)
+        return None
     print("{} log parsing finished".format(file_name))
 
-    info = {"total": total, "succeed": succeed, "total_time": total_time}
+    info = result[0]
+    if metrics is not None:
+        if is_compressed(file_name):
+            read_bytes = os.path.getsize(file_name)
+        else:
+            read_bytes = (os.path.getsize(file_name) if end is None else end) - start
+        metrics.add(info, read_bytes)
 
-    return info, url_stats
+    if error_rate is not None and info["total"] and 1 - info["succeed"] / info["total"] > error_rate:
+        logging.error("{}% errors occurred during parsing log file {}. Abort."
+                      .format((1 - info["succeed"] / info["total"]) * 100, file_name))
+        return None
 
+    return result
 
-def get_stats(url, request_times, succeed, total_time):
-    """Calculate url's statistics"""
 
-    time_sum = sum(request_times)
-    count = len(request_times)
+if timed is not None:
+    parse_log_file = timed(parse_log_file)
+
+
+def file_fingerprint(file_name, size=FINGERPRINT_SIZE):
+    """Calculate hash of first size bytes of file"""
+
+    with open(file_name, "rb") as log_file:
+        return hashlib.sha1(log_file.read(size)).hexdigest()
+
+
+def log_file_identity(file_name):
+    """
+    Get log file identity: device, inode, size
+    and fingerprint of the beginning of the file
+    """
+
+    stat = os.stat(file_name)
+    head_size = min(stat.st_size, FINGERPRINT_SIZE)
+    return {"device": stat.st_dev,
+            "inode": stat.st_ino,
+            "size": stat.st_size,
+            "head_size": head_size,
+            "head": file_fingerprint(file_name, head_size)}
+
+
+def is_checkpoint_valid(checkpoint, file_name, identity, quantile_error):
+    """
+    Check that log file is the same file checkpoint was made for
+    and it was only appended since then, not rotated or truncated
+    """
+
+    return (checkpoint is not None
+            and checkpoint["log_file"] == os.path.abspath(file_name)
+            and checkpoint["device"] == identity["device"]
+            and checkpoint["inode"] == identity["inode"]
+            and checkpoint["offset"] <= identity["size"]
+            and checkpoint["quantile_error"] == quantile_error
+            and checkpoint["head"] == file_fingerprint(file_name, checkpoint["head_size"]))
+
+
+def find_last_line_end(file_name, start, end):
+    """Find offset after the last complete line of the file part from start to end offset"""
+
+    with open(file_name, "rb") as log_file:
+        position = end
+        while position > start:
+            block_start = max(start, position - 64 * 1024)
+            log_file.seek(block_start)
+            line_end = log_file.read(position - block_start).rfind(b"\n")
+            if line_end != -1:
+                return block_start + line_end + 1
+            position = block_start
+
+    return start
+
+
+def serialize_url_stats(url_stats):
+    """Convert urls request times to json compatible dictionary"""
+
+    return {url: request_times.to_dict() if isinstance(request_times, RequestTimes) else request_times
+            for url, request_times in url_stats.items()}
+
+
+def deserialize_url_stats(data):
+    """Restore urls request times from json compatible dictionary"""
+
+    return {url: RequestTimes.from_dict(request_times) if isinstance(request_times, dict) else request_times
+            for url, request_times in data.items()}
+
+
+def load_checkpoint(checkpoint_file_name):
+    """Load checkpoint of incremental analysis, returns None if there is no checkpoint"""
+
+    if not os.path.isfile(checkpoint_file_name):
+        return None
+    with open(checkpoint_file_name, encoding="utf-8") as checkpoint_file:
+        return json.load(checkpoint_file)
+
+
+def save_checkpoint(checkpoint, checkpoint_file_name):
+    """Atomically save checkpoint of incremental analysis"""
+
+    with NamedTemporaryFile(mode="w", encoding="utf-8", dir=os.path.dirname(checkpoint_file_name) or ".",
+                            delete=False) as temp_checkpoint_file:
+        json.dump(checkpoint, temp_checkpoint_file)
+    os.replace(temp_checkpoint_file.name, checkpoint_file_name)
+
+
+def parse_log_file_incremental(pattern, file_name, checkpoint=None, *, quantile_error=None, **parse_options):
+    """
+    Parse complete lines appended to plain log file since checkpoint
+    and merge them with statistics saved in checkpoint.
+    If log file was rotated or truncated statistics is rebuilt from scratch.
+    Returns total statistics, urls request times and new checkpoint,
+    None if parsing of appended lines is aborted by error rate.
+    Parse options are passed to parse_log_file
+    """
+
+    identity = log_file_identity(file_name)
+    if is_checkpoint_valid(checkpoint, file_name, identity, quantile_error):
+        start = checkpoint["offset"]
+        previous = {"total": checkpoint["info"]["total"], "succeed": checkpoint["info"]["succeed"]}, \
+            deserialize_url_stats(checkpoint["url_stats"])
+    else:
+        if checkpoint is not None:
+            logging.info("Log file {} was rotated or truncated. Statistics is rebuilt from scratch."
+                         .format(file_name))
+        start = 0
+        previous = None
+
+    end = find_last_line_end(file_name, start, identity["size"])
+    result = parse_log_file(pattern, file_name, start=start, end=end, quantile_error=quantile_error,
+                            **parse_options)
+    if result is None:
+        return None
+    info, url_stats = merge_parse_results([previous, result] if previous else [result],
+                                          parse_options.get("max_urls", 0))
+
+    checkpoint = dict(identity,
+                      log_file=os.path.abspath(file_name),
+                      offset=end,
+                      quantile_error=quantile_error,
+                      info={"total": info["total"], "succeed": info["succeed"]},
+                      url_stats=serialize_url_stats(url_stats))
+
+    return info, url_stats, checkpoint
+
+
+def to_request_times(url_stats, quantile_error):
+    """Convert urls request times lists to streaming RequestTimes"""
+
+    aggregated = {}
+    for url, request_times in url_stats.items():
+        if not isinstance(request_times, RequestTimes):
+            times, request_times = request_times, RequestTimes(quantile_error)
+            for time in times:
+                request_times.append(time)
+        aggregated[url] = request_times
+
+    return aggregated
+
+
+def source_identity(file_name):
+    """Get name, size and modification time of log file aggregate was built from"""
+
+    stat = os.stat(file_name)
+    return {"log_file": os.path.basename(file_name), "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def aggregate_file_name(aggregate_dir, date):
+    return os.path.join(aggregate_dir, "aggregate-{:04d}{:02d}{:02d}.json.gz".format(date.year, date.month, date.day))
+
+
+def save_aggregate(file_name, info, url_stats, source, quantile_error):
+    """
+    Atomically save compact per-day aggregate: total statistics
+    and count, sum, max and quantile sketch for every url
+    """
+
+    os.makedirs(os.path.dirname(file_name) or ".", exist_ok=True)
+    aggregate = {"source": source,
+                 "quantile_error": quantile_error,
+                 "info": {"total": info["total"], "succeed": info["succeed"]},
+                 "url_stats": serialize_url_stats(to_request_times(url_stats, quantile_error))}
+    with NamedTemporaryFile(dir=os.path.dirname(file_name) or ".", delete=False) as temp_aggregate_file:
+        with gzip.open(temp_aggregate_file, "wt", encoding="utf-8") as aggregate_file:
+            json.dump(aggregate, aggregate_file, separators=(",", ":"))
+    os.replace(temp_aggregate_file.name, file_name)
+
+
+def load_aggregate(file_name, source, quantile_error):
+    """
+    Load per-day aggregate, returns None if there is no aggregate
+    or it was built from another log file or with another quantile error
+    """
+
+    if not os.path.isfile(file_name):
+        return None
+    with gzip.open(file_name, "rt", encoding="utf-8") as aggregate_file:
+        aggregate = json.load(aggregate_file)
+    if aggregate["source"] != source or aggregate["quantile_error"] != quantile_error:
+        return None
+
+    return aggregate["info"], deserialize_url_stats(aggregate["url_stats"])
+
+
+def parse_log_files_range(pattern, log_files, aggregate_dir, quantile_error, **parse_options):
+    """
+    Merge statistics of several daily log files. Every log file is parsed
+    only once, its aggregate is saved to aggregate_dir and reused later.
+    Returns None if parsing of some log file is aborted by error rate.
+    Parse options are passed to parse_log_file
+    """
+
+    results = []
+    for log_file_name, date in log_files:
+        source = source_identity(log_file_name)
+        file_name = aggregate_file_name(aggregate_dir, date)
+        result = load_aggregate(file_name, source, quantile_error)
+        if result is None:
+            result = parse_log_file(pattern, log_file_name, quantile_error=quantile_error, **parse_options)
+            if result is None:
+                return None
+            save_aggregate(file_name, *result, source, quantile_error)
+        results.append(result)
+
+    return merge_parse_results(results, parse_options.get("max_urls", 0))
+
+
+def percentile(sorted_values, q):
+    """Calculate q-th quantile of sorted values with linear interpolation"""
+
+    position = q * (len(sorted_values) - 1)
+    index = int(position)
+    if index + 1 >= len(sorted_values):
+        return sorted_values[-1]
+    return sorted_values[index] + (sorted_values[index + 1] - sorted_values[index]) * (position - index)
+
+
+def make_stats(url, count, time_sum, time_max, time_med, time_p90, time_p95, time_p99, succeed, total_time):
+    """Report row of url's statistics"""
+
     return {"url": url,
             "count": count,
             "count_perc": round(100 * count / succeed, 3),
             "time_sum": round(time_sum, 3),
             "time_perc": round(100 * time_sum / total_time, 3),
             "time_avg": round(time_sum / count, 3),
-            "time_max": round(max(request_times), 3),
-            "time_med": round(median(request_times), 3)}
+            "time_max": round(time_max, 3),
+            "time_med": round(time_med, 3),
+            "time_p90": round(time_p90, 3),
+            "time_p95": round(time_p95, 3),
+            "time_p99": round(time_p99, 3)}
+
+
+def get_stats(url, request_times, succeed, total_time):
+    """
+    Calculate url's statistics from request times list
+    or from streaming RequestTimes
+    """
+
+    if isinstance(request_times, RequestTimes):
+        count = request_times.count
+        time_sum = request_times.time_sum
+        time_max = request_times.time_max
+        time_med, time_p90, time_p95, time_p99 = request_times.quantiles([0.5, 0.9, 0.95, 0.99])
+    else:
+        count = len(request_times)
+        time_sum = sum(request_times)
+        request_times = sorted(request_times)
+        time_max = request_times[-1]
+        time_med = median(request_times)
+        time_p90, time_p95, time_p99 = (percentile(request_times, q) for q in (0.9, 0.95, 0.99))
+
+    return make_stats(url, count, time_sum, time_max, time_med, time_p90, time_p95, time_p99, succeed, total_time)
+
+
+def get_stats_batch(urls_request_times, succeed, total_time):
+    """
+    Calculate statistics of several urls from request times lists with numpy.
+    Request times of all urls are put into one array, every url's part
+    of it is sorted in place and median and percentiles of all urls
+    are calculated at once with the same formulas as in get_stats
+    """
+
+    counts = numpy.fromiter((len(request_times) for _, request_times in urls_request_times), numpy.int64,
+                            len(urls_request_times))
+    offsets = numpy.zeros_like(counts)
+    numpy.cumsum(counts[:-1], out=offsets[1:])
+    values = numpy.fromiter(chain.from_iterable(request_times for _, request_times in urls_request_times),
+                            numpy.float64, int(counts.sum()))
+
+    # python sum is compensated, it is cheap and keeps report equal to get_stats one
+    time_sums = numpy.fromiter((sum(request_times) for _, request_times in urls_request_times), numpy.float64,
+                               len(urls_request_times))
+    for start, end in zip(offsets.tolist(), (offsets + counts).tolist()):
+        values[start:end].sort()
+    time_maxs = values[offsets + counts - 1]
+
+    middle = offsets + counts // 2
+    time_meds = numpy.where(counts % 2, values[middle], (values[middle - (counts % 2 == 0)] + values[middle]) / 2)
+
+    def percentiles(q):
+        position = q * (counts - 1)
+        index = position.astype(numpy.int64)
+        lower = values[offsets + index]
+        upper = values[offsets + numpy.minimum(index + 1, counts - 1)]
+        return lower + (upper - lower) * (position - index)
+
+    columns = [counts, time_sums, time_maxs, time_meds, percentiles(0.9), percentiles(0.95), percentiles(0.99)]
+    return [make_stats(url, *row, succeed, total_time)
+            for (url, _), row in zip(urls_request_times, zip(*(column.tolist() for column in columns)))]
+
+
+def time_sum_key(url_request_times):
+    """Rounded total request time of url, the key urls are ranked by in report"""
+
+    request_times = url_request_times[1]
+    if isinstance(request_times, RequestTimes):
+        return round(request_times.time_sum, 3)
+    return round(sum(request_times), 3)
 
 
 def prepare_report(url_stats, info, report_size):
-    """Prepare url's statistics and filter urls with longest request time"""
+    """
+    Filter urls with longest total request time and prepare their statistics.
+    Urls are selected with heap by total request time only, expensive
+    statistics like median is calculated for selected urls only,
+    at once for all of them with numpy if it is installed
+    """
 
-    all_urls_stats = []
-    for url, request_times in url_stats.items():
-        all_urls_stats.append(get_stats(url, request_times, info["succeed"], info["total_time"]))
+    top_urls = heapq.nlargest(report_size, url_stats.items(), key=time_sum_key)
+    if numpy is not None and top_urls and not isinstance(top_urls[0][1], RequestTimes):
+        return get_stats_batch(top_urls, info["succeed"], info["total_time"])
 
-    return list(sorted(all_urls_stats,
-                       key=lambda report: report["time_sum"],
-                       reverse=True))[:report_size]
+    return [get_stats(url, request_times, info["succeed"], info["total_time"]) for url, request_times in top_urls]
 
 
-def write_report_to_html(report, report_template, report_file_name):
-    """Save report to file"""
+def iter_report_json(report):
+    """Report rows as chunks of json array safe to embed into html"""
 
-    json_information = json.dumps(report)
+    yield "["
+    for i, row in enumerate(report):
+        yield (", " if i else "") + json.dumps(row).translate(HTML_JSON_ESCAPES)
+    yield "]"
 
-    with open(report_template, mode="r", encoding="utf-8") as html_file:
-        html = Template(html_file.read())
 
-    html = html.safe_substitute(table_json=json_information)
+def write_report_to_html(report, report_template, report_file_name, overwrite=False):
+    """
+    Save report to file, existing report is replaced only with overwrite.
+    Report rows are written into $table_json of template one by one,
+    report may be any iterable of rows
+    """
+
+    with open(report_template, mode="r", encoding="utf-8") as html_file:
+        html_parts = TABLE_JSON_PLACEHOLDER.split(html_file.read(), maxsplit=1)
 
     with NamedTemporaryFile(mode="w", encoding="utf-8", dir=os.path.dirname(report_file_name)) as temp_report_file:
-        temp_report_file.write(html)
-        os.link(temp_report_file.name, report_file_name)
+        temp_report_file.write(Template(html_parts[0]).safe_substitute())
+        if len(html_parts) > 1:
+            temp_report_file.writelines(iter_report_json(report))
+            temp_report_file.write(Template(html_parts[1]).safe_substitute())
+        temp_report_file.flush()
+        if overwrite:
+            os.link(temp_report_file.name, temp_report_file.name + ".report")
+            os.replace(temp_report_file.name + ".report", report_file_name)
+        else:
+            os.link(temp_report_file.name, report_file_name)
+
+
+def cpu_time():
+    """
+    CPU time of current process and its finished child processes,
+    only of current process without resource module
+    """
+
+    if resource is None:
+        return process_time()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime + children_usage.ru_utime + children_usage.ru_stime
+
+
+def peak_memory():
+    """
+    Peak resident set size in bytes of current process or its largest finished child process,
+    None without resource module
+    """
+
+    if resource is None:
+        return None
+    return 1024 * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+class RunMetrics:
+    """
+    Metrics of one log_analyzer run: wall and CPU time of every stage,
+    parsed and failed lines, read bytes and peak memory.
+    CPU time and peak memory include finished worker and decompressor processes
+    """
+
+    def __init__(self, profile=False):
+        self.stages = {}
+        self.lines = 0
+        self.failed_lines = 0
+        self.read_bytes = 0
+        self.profiler = cProfile.Profile() if profile else None
+
+    @contextmanager
+    def stage(self, name, profile=False):
+        """Measure stage, stage with profile is profiled with cProfile if profiling is on"""
+
+        profiler = self.profiler if profile else None
+        wall, cpu = perf_counter(), cpu_time()
+        if profiler:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler:
+                profiler.disable()
+            wall, cpu = perf_counter() - wall, cpu_time() - cpu
+            stage = self.stages.setdefault(name, {"wall": 0, "cpu": 0})
+            stage["wall"] += wall
+            stage["cpu"] += cpu
+            logging.info("Stage {} finished in {:.3f}s, CPU time {:.3f}s".format(name, wall, cpu))
+
+    def add(self, info, read_bytes):
+        """Add lines of parse result and bytes read from log file"""
+
+        self.lines += info["total"]
+        self.failed_lines += info["total"] - info["succeed"]
+        self.read_bytes += read_bytes
+
+    def throughput(self):
+        """Parsed lines and read bytes per second of parse stage"""
+
+        wall = self.stages.get("parse", {}).get("wall")
+        if not wall:
+            return 0, 0
+        return self.lines / wall, self.read_bytes / wall
+
+    def to_prometheus(self, succeed, report=None):
+        """
+        Metrics in Prometheus text format, with report every sample has report label,
+        so that metrics files of several reports don't have the same series
+        """
+
+        lines_per_second, bytes_per_second = self.throughput()
+        metrics = [
+            ("stage_wall_seconds", "Wall time of log_analyzer stage",
+             [('stage="{}"'.format(name), stage["wall"]) for name, stage in self.stages.items()]),
+            ("stage_cpu_seconds", "CPU time of log_analyzer stage including worker processes",
+             [('stage="{}"'.format(name), stage["cpu"]) for name, stage in self.stages.items()]),
+            ("lines", "Parsed log lines", [("", self.lines)]),
+            ("failed_lines", "Log lines which cannot be parsed", [("", self.failed_lines)]),
+            ("read_bytes", "Bytes read from log files", [("", self.read_bytes)]),
+            ("lines_per_second", "Parsed lines per second", [("", lines_per_second)]),
+            ("read_bytes_per_second", "Bytes read from log files per second", [("", bytes_per_second)]),
+            ("peak_memory_bytes", "Peak resident set size of log_analyzer process", [("", peak_memory())]),
+            ("last_run_success", "1 if report was saved, 0 if run was aborted", [("", int(succeed))]),
+            ("last_run_timestamp_seconds", "Time when log_analyzer run finished",
+             [("", datetime.datetime.now().timestamp())]),
+        ]
+
+        report_label = 'report="{}"'.format(report) if report else ""
+        text = []
+        for name, help_text, samples in metrics:
+            samples = [(labels, value) for labels, value in samples if value is not None]
+            if not samples:
+                continue
+            text.append("# HELP log_analyzer_{} {}".format(name, help_text))
+            text.append("# TYPE log_analyzer_{} gauge".format(name))
+            for labels, value in samples:
+                labels = ",".join(label for label in (report_label, labels) if label)
+                text.append("log_analyzer_{}{} {}".format(name, "{" + labels + "}" if labels else "", value))
+        return "\n".join(text) + "\n"
+
+    def save(self, report_file_name, succeed):
+        """
+        Log metrics and save them next to the report in Prometheus textfile format,
+        cProfile statistics of profiled stages is dumped there too
+        """
+
+        lines_per_second, bytes_per_second = self.throughput()
+        memory = peak_memory()
+        logging.info("{} lines parsed, {} failed, {} bytes read, {:.0f} lines/s, {:.1f} MB/s, peak memory {}"
+                     .format(self.lines, self.failed_lines, self.read_bytes, lines_per_second,
+                             bytes_per_second / 1024 / 1024,
+                             "{:.1f} MB".format(memory / 1024 / 1024) if memory is not None else "unknown"))
+
+        base_name = os.path.splitext(report_file_name)[0]
+        with NamedTemporaryFile(mode="w", encoding="utf-8", dir=os.path.dirname(report_file_name) or ".",
+                                delete=False) as temp_metrics_file:
+            temp_metrics_file.write(self.to_prometheus(succeed, os.path.basename(base_name)))
+        # temporary file is readable only by owner, textfile collector may run as other user
+        os.chmod(temp_metrics_file.name, 0o644)
+        os.replace(temp_metrics_file.name, base_name + ".prom")
+
+        if self.profiler:
+            self.profiler.dump_stats(base_name + ".pstats")
+            logging.info("Profile saved into {}".format(base_name + ".pstats"))
+
+
+def save_aborted_metrics(config_, metrics, report_file_name):
+    """Save metrics of aborted run next to the report if METRICS is set"""
+
+    if config_["METRICS"]:
+        metrics.save(report_file_name, False)
+
+
+def save_report(info, url_stats, config_, report_file_name, overwrite=False, metrics=None):
+    """
+    Check rate of parse errors, prepare report and save it to file.
+    Metrics of the run are saved next to the report if METRICS is set.
+    Returns True if report is saved
+    """
+
+    metrics = metrics or RunMetrics()
+
+    errors = 1 - info["succeed"] / info["total"] if info["total"] else 0
+    if errors > config_["ERROR_RATE"]:
+        logging.error("{}% errors occurred during parsing log file. Abort."
+                      .format(errors * 100))
+        save_aborted_metrics(config_, metrics, report_file_name)
+        return False
+
+    with metrics.stage("prepare_report"):
+        report = prepare_report(url_stats, info, config_["REPORT_SIZE"])
+    with metrics.stage("write_report"):
+        write_report_to_html(report, config_["REPORT_TEMPLATE"], report_file_name, overwrite)
+    if config_["METRICS"]:
+        metrics.save(report_file_name, True)
+    print("All operations completed. Report saved into {}".format(report_file_name))
+    return True
+
+
+def get_parse_options(config_):
+    """Get parse_log_file options from config"""
+
+    url_normalizer = None
+    if config_["URL_REWRITE_RULES"] or config_["STRIP_QUERY"]:
+        url_normalizer = UrlNormalizer(config_["URL_REWRITE_RULES"], config_["STRIP_QUERY"])
+
+    return {"workers": config_["WORKERS"],
+            "decompressor": config_["DECOMPRESSOR"],
+            "use_mmap": config_["MMAP"],
+            "tokenizer": log_format_tokenizer(config_["LOG_FORMAT"]),
+            "url_normalizer": url_normalizer,
+            "max_urls": config_["MAX_URLS"]}
+
+
+def export_dir_name(config_, log_file_name):
+    """Directory in EXPORT_DIR for exported columns of log file, None if export is off"""
+
+    if not config_["EXPORT_DIR"]:
+        return None
+    return os.path.join(config_["EXPORT_DIR"], os.path.basename(log_file_name))
+
+
+def daily_report_file_name(report_dir, date):
+    """Name of report of daily log file"""
+
+    return os.path.join(report_dir, "report-{:04d}.{:02d}.{:02d}.html".format(date.year, date.month, date.day))
+
+
+def make_daily_report(config_, log_file_name, date, metrics=None):
+    """
+    Parse daily log file from LOG_DIR, save its report and, with DAILY_AGGREGATES,
+    its aggregate, returns True if report is saved
+    """
+
+    metrics = metrics or RunMetrics(config_["PROFILE"])
+    report_file_name = daily_report_file_name(config_["REPORT_DIR"], date)
+    log_file_name = os.path.join(config_["LOG_DIR"], log_file_name)
+
+    quantile_error = config_["QUANTILE_ERROR"] if config_["STREAMING_STATS"] else None
+    with metrics.stage("parse", profile=True):
+        result = parse_log_file(log_format_pattern(config_["LOG_FORMAT"]), log_file_name, config_["ERROR_RATE"],
+                                quantile_error=quantile_error, metrics=metrics,
+                                export_dir=export_dir_name(config_, log_file_name), **get_parse_options(config_))
+    if result is None:
+        save_aborted_metrics(config_, metrics, report_file_name)
+        return False
+    info, url_stats = result
+
+    if config_["AGGREGATE_DIR"] and config_["DAILY_AGGREGATES"]:
+        with metrics.stage("save_aggregate"):
+            save_aggregate(aggregate_file_name(config_["AGGREGATE_DIR"], date), info, url_stats,
+                           source_identity(log_file_name), config_["QUANTILE_ERROR"])
+    return save_report(info, url_stats, config_, report_file_name, metrics=metrics)
+
+
+def make_daily_report_logged(config_, log_file):
+    """make_daily_report for process pool, errors are logged and don't stop other reports"""
+
+    try:
+        return make_daily_report(config_, *log_file)
+    except Exception as e:
+        logging.exception("Error while making report for {}:\n{}".format(log_file[0], e))
+        return False
+
+
+def find_unreported_log_files(config_, min_age=0):
+    """
+    Find daily log files in LOG_DIR without report in REPORT_DIR,
+    log files modified less than min_age seconds ago are skipped
+    """
+
+    log_files = []
+    now = datetime.datetime.now().timestamp()
+    for log_file_name, date in find_log_files(NGINX_FILE_NAME_PATTERN, config_["LOG_DIR"],
+                                              index_file_name=config_["LOG_INDEX"]):
+        if os.path.isfile(daily_report_file_name(config_["REPORT_DIR"], date)):
+            continue
+        if min_age and now - os.path.getmtime(os.path.join(config_["LOG_DIR"], log_file_name)) < min_age:
+            continue
+        log_files.append((log_file_name, date))
+
+    return log_files
+
+
+def make_daily_reports(config_, log_files):
+    """
+    Make reports of several daily log files in BATCH_WORKERS processes,
+    returns list of log files with saved reports
+    """
+
+    workers = min(config_["BATCH_WORKERS"] or os.cpu_count(), len(log_files))
+    if workers <= 1:
+        results = [make_daily_report_logged(config_, log_file) for log_file in log_files]
+    else:
+        # pool processes can't start their own parsing pools
+        batch_config = dict(config_, WORKERS=1)
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(partial(make_daily_report_logged, batch_config), log_files, chunksize=1)
+
+    return [log_file for log_file, saved in zip(log_files, results) if saved]
+
+
+def main_batch(config_):
+    """Make reports of all daily log files which don't have reports yet"""
+
+    log_files = find_unreported_log_files(config_)
+    if not log_files:
+        logging.info("All log files are reported. Nothing to do. Exit.")
+        return
+
+    logging.info("Making reports for {} log files".format(len(log_files)))
+    reported = make_daily_reports(config_, log_files)
+    logging.info("{} of {} reports saved".format(len(reported), len(log_files)))
+
+
+def main_watch(config_):
+    """
+    Make reports of daily log files without reports and then check LOG_DIR
+    every WATCH_INTERVAL seconds for new rotated log files.
+    Log files are reported when they were not modified for WATCH_INTERVAL,
+    log files which failed are not retried until they are modified
+    """
+
+    failed = {}
+    logging.info("Watching {} for new log files".format(config_["LOG_DIR"]))
+    try:
+        while True:
+            log_files = [(log_file_name, date) for log_file_name, date
+                         in find_unreported_log_files(config_, config_["WATCH_INTERVAL"])
+                         if failed.get(log_file_name) != os.path.getmtime(os.path.join(config_["LOG_DIR"],
+                                                                                       log_file_name))]
+            if log_files:
+                logging.info("Making reports for {} log files".format(len(log_files)))
+                reported = make_daily_reports(config_, log_files)
+                for log_file_name, date in set(log_files) - set(reported):
+                    failed[log_file_name] = os.path.getmtime(os.path.join(config_["LOG_DIR"], log_file_name))
+            sleep(config_["WATCH_INTERVAL"])
+    except KeyboardInterrupt:
+        logging.info("Watching is stopped")
+
+
+def main_incremental(config_):
+    """
+    Analyze log file which is still being written, only lines appended
+    since previous run are parsed, report for today is regenerated.
+    Statistics is always streaming, so that checkpoint doesn't grow with log
+    """
+
+    log_file_name = os.path.join(config_["LOG_DIR"], config_["INCREMENTAL_LOG"])
+    if not os.path.isfile(log_file_name):
+        logging.info("Log file not found. Nothing to parse. Exit.")
+        return
+
+    date = datetime.date.today()
+    report_file_name = "report-{:04d}.{:02d}.{:02d}-live.html".format(date.year, date.month, date.day)
+    report_file_name = os.path.join(config_["REPORT_DIR"], report_file_name)
+
+    metrics = RunMetrics(config_["PROFILE"])
+    checkpoint_file_name = os.path.join(config_["REPORT_DIR"],
+                                        ".checkpoint-{}.json".format(config_["INCREMENTAL_LOG"]))
+    with metrics.stage("parse", profile=True):
+        result = parse_log_file_incremental(log_format_pattern(config_["LOG_FORMAT"]), log_file_name,
+                                            load_checkpoint(checkpoint_file_name), error_rate=config_["ERROR_RATE"],
+                                            quantile_error=config_["QUANTILE_ERROR"],
+                                            metrics=metrics, export_dir=export_dir_name(config_, log_file_name),
+                                            **get_parse_options(config_))
+    if result is None:
+        save_aborted_metrics(config_, metrics, report_file_name)
+        return
+    info, url_stats, checkpoint = result
+    with metrics.stage("save_checkpoint"):
+        save_checkpoint(checkpoint, checkpoint_file_name)
+    if not info["total"]:
+        logging.info("Log file is empty. Nothing to report. Exit.")
+        return
+
+    save_report(info, url_stats, config_, report_file_name, overwrite=True, metrics=metrics)
+
+
+def main_range(config_, date_from, date_to):
+    """
+    Make report for all log files from date_from to date_to
+    from cached per-day aggregates, only new log files are parsed.
+    Range is open if date_from or date_to is None
+    """
+
+    metrics = RunMetrics(config_["PROFILE"])
+    with metrics.stage("find_log"):
+        log_files = find_log_files(NGINX_FILE_NAME_PATTERN, config_["LOG_DIR"], date_from, date_to,
+                                   config_["LOG_INDEX"])
+    if not log_files:
+        logging.info("Log files not found. Nothing to parse. Exit.")
+        return
+    date_from = date_from or log_files[0][1]
+    date_to = date_to or log_files[-1][1]
+
+    report_file_name = "report-{:04d}.{:02d}.{:02d}-{:04d}.{:02d}.{:02d}.html".format(
+        date_from.year, date_from.month, date_from.day, date_to.year, date_to.month, date_to.day)
+    report_file_name = os.path.join(config_["REPORT_DIR"], report_file_name)
+
+    log_files = [(os.path.join(config_["LOG_DIR"], log_file_name), date) for log_file_name, date in log_files]
+    with metrics.stage("parse", profile=True):
+        result = parse_log_files_range(log_format_pattern(config_["LOG_FORMAT"]), log_files, config_["AGGREGATE_DIR"],
+                                       config_["QUANTILE_ERROR"], error_rate=config_["ERROR_RATE"],
+                                       metrics=metrics, **get_parse_options(config_))
+    if result is None:
+        save_aborted_metrics(config_, metrics, report_file_name)
+        return
+    info, url_stats = result
+
+    save_report(info, url_stats, config_, report_file_name, overwrite=True, metrics=metrics)
 
 
 def main(config_):
-        nginx_file_name_pattern = re.compile(".*nginx-access-ui\.log-(?P<date>\d{8})(\.gz)?$")
-        result = find_last_log_file(nginx_file_name_pattern, config_["LOG_DIR"])
+        metrics = RunMetrics(config_["PROFILE"])
+        with metrics.stage("find_log"):
+            result = find_last_log_file(NGINX_FILE_NAME_PATTERN, config_["LOG_DIR"], config_["LOG_INDEX"])
         if not result:
             logging.info("Log file not found. Nothing to parse. Exit.")
-            sys.exit()
+            return
         log_file_name, date = result
 
-        report_file_name = "report-{:04d}.{:02d}.{:02d}.html".format(date.year, date.month, date.day)
-        report_file_name = os.path.join(config_["REPORT_DIR"], report_file_name)
-        if os.path.isfile(report_file_name):
+        if os.path.isfile(daily_report_file_name(config_["REPORT_DIR"], date)):
             logging.info("Log report already exists. Nothing to do. Exit.")
-            sys.exit()
-
-        nginx_log_pattern = re.compile(
-            "(?P<remote_addr>.+)\s+(?P<remote_user>.+)\s+(?P<http_x_real_ip>.+)\s+\[(?P<time_local>.+)\]\s+" \
-            "\"[A-Z]{1,} (?P<request>.+) .*\"\s+(?P<status>.+)\s+(?P<body_bytes_send>.+)\s+" \
-            "\"(?P<http_referer>.+)\"\s+\"(?P<http_user_agent>.+)\"\s+\"(?P<http_x_forwarded_for>.+)\"\s+" \
-            "\"(?P<http_X_REQUEST_ID>.+)\"\s+\"(?P<http_X_RB_USER>.+)\"\s+(?P<request_time>.+)")
+            return
 
-        info, url_stats = parse_log_file(nginx_log_pattern, os.path.join(config_["LOG_DIR"], log_file_name))
-        errors = 1 - info["succeed"] / info["total"]
-        if errors > config_["ERROR_RATE"]:
-            logging.error("{}% errors occurred during parsing log file. Abort."
-                          .format(errors * 100))
-            sys.exit()
-
-        report = prepare_report(url_stats, info, config_["REPORT_SIZE"])
-        write_report_to_html(report, "./report.html", report_file_name)
-        print("All operations completed. Report saved into {}".format(report_file_name))
+        make_daily_report(config_, log_file_name, date, metrics)
 
 
 if __name__ == "__main__":
     parser = optparse.OptionParser()
     parser.add_option("--config", dest="new_config", default=None, type="string")
+    parser.add_option("--incremental", dest="incremental", default=False, action="store_true")
+    parser.add_option("--from", dest="date_from", default=None, type="string", help="YYYYMMDD")
+    parser.add_option("--to", dest="date_to", default=None, type="string", help="YYYYMMDD")
+    parser.add_option("--batch", dest="batch", default=False, action="store_true",
+                      help="make reports of all log files without reports")
+    parser.add_option("--watch", dest="watch", default=False, action="store_true",
+                      help="make reports of all log files without reports and wait for new log files")
+    parser.add_option("--profile", dest="profile", default=False, action="store_true",
+                      help="save cProfile statistics of log parsing next to the report")
     options, args = parser.parse_args()
 
+    try:
+        date_from = datetime.datetime.strptime(options.date_from, "%Y%m%d").date() if options.date_from else None
+        date_to = datetime.datetime.strptime(options.date_to, "%Y%m%d").date() if options.date_to else None
+    except ValueError as e:
+        sys.exit("Wrong date range: {}".format(e))
+
     logger_config = config.copy()
     if options.new_config:
         try:
             update_config(options.new_config, logger_config)
         except (IOError, json.JSONDecodeError, TypeError) as e:
             sys.exit("Error while trying to read configuration file: {}".format(e))
+    if options.profile:
+        logger_config["PROFILE"] = True
 
     logging.basicConfig(filename=logger_config["LOG_NAME"] if logger_config["LOG_NAME"] else None,
                         format="[%(asctime)s] %(levelname).1s %(message)s",
@@ -191,6 +2058,18 @@ if __name__ == "__main__":
                         level=logging.INFO)
 
     try:
-        main(logger_config)
+        if options.watch:
+            main_watch(logger_config)
+        elif options.batch:
+            main_batch(logger_config)
+        elif options.incremental:
+            main_incremental(logger_config)
+        elif date_from or date_to:
+            main_range(logger_config, date_from, date_to)
+        else:
+            main(logger_config)
     except Exception as e:
         logging.exception("Unhandled error:\n{}".format(e))
+
+    if timed is not None:
+        logging.info("Timings of main process:\n{}".format(timings_report()))
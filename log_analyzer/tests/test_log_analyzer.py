@@ -1,13 +1,54 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import bz2
 import os
+import gzip
+import shutil
 import json
 import log_analyzer
+import random
 import re
+import subprocess
+import tempfile
 import unittest
 
 from datetime import date
+from string import Template
+from unittest import mock
+
+CORPUS_FILE_NAME = os.path.join(os.path.dirname(__file__), "ui_short_corpus.log")
+
+
+def ui_short_line(url_id=1, request_time=0.39, status=200, body_bytes_sent=927, second=22):
+    """ui_short log line of request to /api/v2/banner/<url_id>"""
+    return ('1.196.116.32 -  - [29/Jun/2017:03:50:{:02d} +0300] "GET /api/v2/banner/{} HTTP/1.1" {} {} "-" '
+            '"Lynx/2.8.8dev.9" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" {:.3f}\n'
+            .format(second, url_id, status, body_bytes_sent, request_time))
+
+
+def parse_with_pattern(line):
+    """Url and request time of raw ui_short line parsed with UI_SHORT_PATTERN"""
+    match = log_analyzer.UI_SHORT_PATTERN.match(line.decode("utf-8"))
+    try:
+        return match and (match.group("request"), float(match.group("request_time")))
+    except ValueError:
+        return None
+
+
+def corrupted_lines(lines, count, seed):
+    """Random corruptions of lines: insertions of format pieces and deletions"""
+    generator = random.Random(seed)
+    pieces = [b'"', b"[", b"]", b" ", b"\t", b"x", b"GET ", b"-", b"0.5", b"\xc3\xa9", b"\r", b" HTTP/1.1"]
+    for _ in range(count):
+        line = bytearray(generator.choice(lines))
+        for _ in range(generator.randint(1, 3)):
+            position = generator.randrange(len(line) + 1)
+            if generator.random() < 0.5:
+                line[position:position] = generator.choice(pieces)
+            else:
+                del line[position:position + generator.randint(1, 3)]
+        yield bytes(line)
 
 
 class TestLogAnalyzer(unittest.TestCase):
@@ -75,7 +116,7 @@ class TestLogAnalyzer(unittest.TestCase):
             "\"(?P<http_referer>.+)\"\s+\"(?P<http_user_agent>.+)\"\s+\"(?P<http_x_forwarded_for>.+)\"\s+" \
             "\"(?P<http_X_REQUEST_ID>.+)\"\s+\"(?P<http_X_RB_USER>.+)\"\s+(?P<request_time>.+)")
 
-        url_stats, info = log_analyzer.parse_log_file(pattern, file_name, 0.1)
+        info, url_stats = log_analyzer.parse_log_file(pattern, file_name, 0.1)
         self.assertEqual(info["total"], 11)
         self.assertEqual(info["succeed"], 10)
         self.assertEqual(info["total_time"], 2.565)
@@ -90,6 +131,637 @@ class TestLogAnalyzer(unittest.TestCase):
 
         os.remove(file_name)
 
+    def test_split_log_file(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            file_name = os.path.join(log_dir, "test.log")
+            with open(file_name, "wb") as log:
+                log.write(b"first\nsecond line\n\nthird\nlast line without newline")
+
+            for parts in range(1, 10):
+                ranges = log_analyzer.split_log_file(file_name, parts)
+                self.assertEqual(ranges[0][0], 0)
+                self.assertEqual(ranges[-1][1], os.path.getsize(file_name))
+                with open(file_name, "rb") as log:
+                    data = log.read()
+                lines = []
+                for start, end in ranges:
+                    self.assertTrue(start == 0 or data[start - 1:start] == b"\n")
+                    lines.extend(data[start:end].decode().splitlines())
+                self.assertEqual(lines, data.decode().splitlines())
+
+    def test_parse_log_file_parallel(self):
+        lines = [ui_short_line(i % 17, (i * 7919 % 1000) / 1000) if i % 13 else "broken line\n" for i in range(3000)]
+        pattern = log_analyzer.UI_SHORT_PATTERN
+
+        with tempfile.TemporaryDirectory() as log_dir:
+            plain_file = os.path.join(log_dir, "test.log")
+            with open(plain_file, "w") as log:
+                log.writelines(lines)
+            gz_file = os.path.join(log_dir, "test.log.gz")
+            with gzip.open(gz_file, "wt") as log:
+                log.writelines(lines)
+
+            serial = log_analyzer.parse_log_file(pattern, plain_file)
+            self.assertEqual(serial[0]["total"], 3000)
+            self.assertEqual(log_analyzer.parse_log_file(pattern, plain_file, use_mmap=True), serial)
+            self.assertEqual(log_analyzer.parse_log_file(pattern, plain_file, workers=3, use_mmap=True), serial)
+            self.assertEqual(log_analyzer.parse_log_file(pattern, gz_file), serial)
+            self.assertEqual(log_analyzer.parse_log_file(pattern, plain_file, workers=4), serial)
+            self.assertEqual(log_analyzer.parse_log_file_parallel(pattern, gz_file, 3, block_size=1000), serial)
+
+            streaming = log_analyzer.parse_log_file(pattern, plain_file, quantile_error=0.01)
+            parallel_streaming = log_analyzer.parse_log_file(pattern, plain_file, workers=4, quantile_error=0.01)
+            self.assertEqual(streaming[0]["total"], serial[0]["total"])
+            self.assertEqual(streaming[0]["succeed"], serial[0]["succeed"])
+            self.assertAlmostEqual(streaming[0]["total_time"], serial[0]["total_time"])
+            for url, request_times in serial[1].items():
+                for result in (streaming, parallel_streaming):
+                    self.assertEqual(result[1][url].count, len(request_times))
+                    self.assertEqual(result[1][url].time_max, max(request_times))
+                    self.assertEqual(result[1][url].sketch.buckets, streaming[1][url].sketch.buckets)
+
+    def test_quantile_sketch(self):
+        generator = random.Random(46)
+        values = [round(generator.lognormvariate(-2, 1.5), 3) for _ in range(20000)] + [0.0] * 500
+        sketch = log_analyzer.QuantileSketch(0.01)
+        for value in values:
+            sketch.add(value)
+        values.sort()
+
+        qs = [0, 0.01, 0.25, 0.5, 0.9, 0.95, 0.99, 1]
+        for q, estimate in zip(qs, sketch.quantiles(qs)):
+            exact = values[int(q * (len(values) - 1))]
+            self.assertLessEqual(abs(estimate - exact), 0.01 * exact + 1e-12)
+
+        # memory depends on values range only
+        buckets = len(sketch.buckets)
+        for value in values:
+            sketch.add(value)
+        self.assertEqual(len(sketch.buckets), buckets)
+
+        restored = log_analyzer.QuantileSketch.from_dict(json.loads(json.dumps(sketch.to_dict())))
+        self.assertEqual(restored.quantiles(qs), sketch.quantiles(qs))
+
+    def test_streaming_stats(self):
+        generator = random.Random(121)
+        times = [round(generator.expovariate(5), 3) for _ in range(5000)]
+        streaming = log_analyzer.RequestTimes(0.01)
+        halves = log_analyzer.RequestTimes(0.01), log_analyzer.RequestTimes(0.01)
+        for i, time in enumerate(times):
+            streaming.append(time)
+            halves[i % 2].append(time)
+        halves[0].merge(halves[1])
+
+        exact_stats = log_analyzer.get_stats("/url", times, 10000, 1000.0)
+        for stats in (log_analyzer.get_stats("/url", streaming, 10000, 1000.0),
+                      log_analyzer.get_stats("/url", halves[0], 10000, 1000.0)):
+            for key in ("count", "count_perc", "time_sum", "time_perc", "time_avg", "time_max"):
+                self.assertAlmostEqual(stats[key], exact_stats[key], places=2)
+            for key in ("time_med", "time_p90", "time_p95", "time_p99"):
+                self.assertLessEqual(abs(stats[key] - exact_stats[key]), 0.011 * exact_stats[key] + 0.002)
+
+        self.assertEqual(exact_stats["time_p90"], round(log_analyzer.percentile(sorted(times), 0.9), 3))
+
+    def test_tokenize_ui_short(self):
+        corpus_file_name = CORPUS_FILE_NAME
+        with open(corpus_file_name, "rb") as corpus_file:
+            corpus = corpus_file.read().split(b"\n")
+
+        accepted = 0
+        for line in corpus:
+            parsed = log_analyzer.tokenize_ui_short(line)
+            if parsed is not None:
+                accepted += 1
+                self.assertEqual(parsed, parse_with_pattern(line), line)
+        self.assertGreaterEqual(accepted, 15)
+
+        # random corruptions of well-formed lines
+        well_formed = [line for line in corpus if log_analyzer.tokenize_ui_short(line)]
+        for line in corrupted_lines(well_formed, 3000, 3):
+            parsed = log_analyzer.tokenize_ui_short(line)
+            if parsed is not None:
+                self.assertEqual(parsed, parse_with_pattern(line), line)
+
+        # tokenizer doesn't change parse result, rejected lines are parsed with pattern
+        self.assertEqual(log_analyzer.parse_log_file(log_analyzer.UI_SHORT_PATTERN, corpus_file_name,
+                                                     tokenizer=log_analyzer.tokenize_ui_short),
+                         log_analyzer.parse_log_file(log_analyzer.UI_SHORT_PATTERN, corpus_file_name))
+
+    def test_log_format(self):
+        log_format = '$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent ' \
+                     '"$http_referer" "$http_user_agent" ${request_time}s'
+        line = b'10.0.0.1 - - [29/Jun/2017:03:50:22 +0300] "POST /api/v1/login?next=/ HTTP/1.1" 302 0 ' \
+               b'"-" "curl/7.52.1" 0.012s'
+
+        extract = log_analyzer.compile_log_format(log_format, ("status", "remote_addr", "request"))
+        self.assertEqual(extract(line), (b"302", b"10.0.0.1", b"POST /api/v1/login?next=/ HTTP/1.1"))
+        self.assertIs(log_analyzer.compile_log_format(log_format, ("status", "remote_addr", "request")), extract)
+        # scanning stops after the last requested variable
+        self.assertEqual(extract(line[:line.find(b" 0 ")]), None)
+        self.assertEqual(extract(line[:line.find(b" 0 ") + 1]), (b"302", b"10.0.0.1",
+                                                                  b"POST /api/v1/login?next=/ HTTP/1.1"))
+        self.assertIsNone(extract(line.replace(b"[", b"")))
+        with self.assertRaises(ValueError):
+            log_analyzer.compile_log_format(log_format, ("upstream_response_time",))
+        with self.assertRaises(ValueError):
+            log_analyzer.compile_log_format("$status$request_time", ("status",))
+
+        tokenizer = log_analyzer.LogFormat(log_format)
+        self.assertEqual(tokenizer(line), ("/api/v1/login?next=/", 0.012))
+        self.assertIsNone(tokenizer(line.replace(b"0.012s", b"-s")))
+        self.assertIsNone(tokenizer(line.replace(b'"POST ', b'"')))
+        self.assertEqual(tokenizer.export_fields(line), (b"29/Jun/2017:03:50:22 +0300", b"302", b"0"))
+        self.assertEqual(log_analyzer.LogFormat('"$request" $request_time').export_fields(b'"GET / HTTP/1.1" 1'),
+                         (b"", b"", b""))
+
+        # ui_short format gives exactly the same result as regex
+        ui_short = log_analyzer.log_format_tokenizer(log_analyzer.UI_SHORT_LOG_FORMAT)
+        ui_short_pattern = log_analyzer.log_format_pattern(log_analyzer.UI_SHORT_LOG_FORMAT)
+        self.assertIsInstance(log_analyzer.log_format_tokenizer(log_format), log_analyzer.LogFormat)
+        self.assertIsNone(log_analyzer.log_format_pattern(log_format))
+        with open(CORPUS_FILE_NAME, "rb") as corpus_file:
+            corpus = corpus_file.read().split(b"\n")
+        lines = corpus + list(corrupted_lines([line for line in corpus if ui_short(line)], 5000, 18))
+        for corpus_line in lines:
+            parsed = ui_short(corpus_line)
+            if parsed is not None:
+                self.assertEqual(parsed, parse_with_pattern(corpus_line), corpus_line)
+        with tempfile.TemporaryDirectory() as log_dir:
+            file_name = os.path.join(log_dir, "access.log")
+            with open(file_name, "wb") as log:
+                log.write(b"\n".join(lines))
+            self.assertEqual(log_analyzer.parse_log_file(ui_short_pattern, file_name, tokenizer=ui_short),
+                             log_analyzer.parse_log_file(log_analyzer.UI_SHORT_PATTERN, file_name))
+
+        # lines rejected by tokenizer are errors without pattern, tokenizer is passed to workers,
+        # time_local which is not ASCII is exported as 0
+        lines = [line.replace(b"/login", "/page/{}".format(i % 5).encode()) for i in range(1000)]
+        lines += [line.replace(b"+0300]", "+0300é]".encode("utf-8")), b"broken"]
+        with tempfile.TemporaryDirectory() as log_dir:
+            file_name = os.path.join(log_dir, "access.log")
+            with open(file_name, "wb") as log:
+                log.write(b"\n".join(lines))
+            export_dir = os.path.join(log_dir, "export")
+            info, url_stats = log_analyzer.parse_log_file(None, file_name, tokenizer=tokenizer, export_dir=export_dir)
+            self.assertEqual((info["total"], info["succeed"]), (1002, 1001))
+            self.assertEqual(url_stats["/api/v1/page/3?next=/"], [0.012] * 200)
+            self.assertEqual(log_analyzer.parse_log_file(None, file_name, workers=2, tokenizer=tokenizer),
+                             (info, url_stats))
+            columns = log_analyzer.load_columns(export_dir, ("time_local", "status", "body_bytes_send"))
+            self.assertEqual(set(columns["time_local"]), {1498697422, 0})
+            self.assertEqual(set(columns["status"]), {302})
+            self.assertEqual(set(columns["body_bytes_send"]), {0})
+
+    def test_parse_log_file_incremental(self):
+        lines = [ui_short_line(i % 7, i / 1000) for i in range(1, 301)]
+        pattern = log_analyzer.UI_SHORT_PATTERN
+
+        with tempfile.TemporaryDirectory() as log_dir:
+            file_name = os.path.join(log_dir, "nginx-access-ui.log")
+            checkpoint_file_name = os.path.join(log_dir, "checkpoint.json")
+            for quantile_error in (None, 0.01):
+                with open(file_name, "w") as log:
+                    log.writelines(lines[:100])
+                    log.write(lines[100][:20])
+                result = log_analyzer.parse_log_file_incremental(pattern, file_name, quantile_error=quantile_error)
+                self.assertEqual(result[0]["total"], 100)
+                log_analyzer.save_checkpoint(result[2], checkpoint_file_name)
+
+                # only appended lines are parsed, incomplete line is left for the next run
+                with open(file_name, "a") as log:
+                    log.write(lines[100][20:])
+                    log.writelines(lines[101:])
+                checkpoint = log_analyzer.load_checkpoint(checkpoint_file_name)
+                info, url_stats, checkpoint = log_analyzer.parse_log_file_incremental(
+                    pattern, file_name, checkpoint, quantile_error=quantile_error)
+                expected_info, expected_url_stats = log_analyzer.parse_log_file(pattern, file_name,
+                                                                                quantile_error=quantile_error)
+                self.assertEqual((info["total"], info["succeed"]), (expected_info["total"], expected_info["succeed"]))
+                self.assertAlmostEqual(info["total_time"], expected_info["total_time"])
+                if quantile_error is None:
+                    self.assertEqual(url_stats, expected_url_stats)
+                else:
+                    self.assertEqual({url: request_times.count for url, request_times in url_stats.items()},
+                                     {url: request_times.count for url, request_times in expected_url_stats.items()})
+                self.assertEqual(checkpoint["offset"], os.path.getsize(file_name))
+
+                # truncated file
+                with open(file_name, "w") as log:
+                    log.writelines(lines[:50])
+                info = log_analyzer.parse_log_file_incremental(pattern, file_name, checkpoint,
+                                                               quantile_error=quantile_error)[0]
+                self.assertEqual(info["total"], 50)
+
+                # rotated file which is already bigger than checkpoint offset
+                os.rename(file_name, file_name + "-rotated")
+                with open(file_name, "w") as log:
+                    log.writelines(reversed(lines))
+                info = log_analyzer.parse_log_file_incremental(pattern, file_name, checkpoint,
+                                                               quantile_error=quantile_error)[0]
+                self.assertEqual(info["total"], 300)
+                os.remove(file_name + "-rotated")
+
+    def test_parse_log_files_range(self):
+        pattern = log_analyzer.UI_SHORT_PATTERN
+
+        with tempfile.TemporaryDirectory() as log_dir:
+            aggregate_dir = os.path.join(log_dir, "aggregates")
+            for day in range(1, 6):
+                file_name = os.path.join(log_dir, "nginx-access-ui.log-201706{:02d}".format(day))
+                open_log = gzip.open if day % 2 else open
+                with open_log(file_name + (".gz" if day % 2 else ""), "wt") as log:
+                    log.writelines(ui_short_line(i % (day + 2), i * day / 1000) for i in range(100))
+            open(os.path.join(log_dir, "nginx-access-ui.log-20170606.bz2"), "w").close()
+
+            log_files = log_analyzer.find_log_files(log_analyzer.NGINX_FILE_NAME_PATTERN, log_dir,
+                                                    date(2017, 6, 2), date(2017, 6, 4))
+            self.assertEqual([log_date for _, log_date in log_files], [date(2017, 6, d) for d in (2, 3, 4)])
+            log_files = [(os.path.join(log_dir, file_name), log_date) for file_name, log_date in log_files]
+
+            info, url_stats = log_analyzer.parse_log_files_range(pattern, log_files, aggregate_dir, 0.01)
+            self.assertEqual(len(os.listdir(aggregate_dir)), 3)
+            self.assertEqual(info["total"], 300)
+
+            # cached aggregates are used instead of log files
+            parsed = []
+            parse_log_file = log_analyzer.parse_log_file
+            log_analyzer.parse_log_file = lambda *args, **kwargs: parsed.append(args) or parse_log_file(*args,
+                                                                                                         **kwargs)
+            try:
+                cached_info, cached_url_stats = log_analyzer.parse_log_files_range(pattern, log_files,
+                                                                                   aggregate_dir, 0.01)
+            finally:
+                log_analyzer.parse_log_file = parse_log_file
+            self.assertEqual(parsed, [])
+            self.assertEqual(log_analyzer.prepare_report(cached_url_stats, cached_info, 10),
+                             log_analyzer.prepare_report(url_stats, info, 10))
+
+            # aggregate of changed log file is rebuilt
+            with open(log_files[0][0], "a") as log:
+                log.write(ui_short_line(1, 1))
+            self.assertEqual(log_analyzer.parse_log_files_range(pattern, log_files, aggregate_dir, 0.01)[0]["total"],
+                             301)
+
+    def test_prepare_report(self):
+        generator = random.Random(6)
+        url_stats = {"/url/{}".format(i): [generator.choice([0.1, 0.2, 0.3]) for _ in range(generator.randint(1, 5))]
+                     for i in range(500)}
+        info = {"succeed": sum(map(len, url_stats.values())),
+                "total_time": log_analyzer.total_request_time(url_stats)}
+
+        all_urls_stats = [log_analyzer.get_stats(url, request_times, info["succeed"], info["total_time"])
+                          for url, request_times in url_stats.items()]
+        expected = sorted(all_urls_stats, key=lambda report: report["time_sum"], reverse=True)
+        for report_size in (0, 1, 10, 499, 500, 1000):
+            self.assertEqual(log_analyzer.prepare_report(url_stats, info, report_size), expected[:report_size])
+
+    @unittest.skipIf(log_analyzer.numpy is None, "numpy is not installed")
+    def test_get_stats_batch(self):
+        generator = random.Random(17)
+        urls_request_times = [("/url/{}".format(i), [generator.lognormvariate(-2, 1) for _ in range(count)])
+                              for i, count in enumerate([1, 2, 3, 4, 10, 11, 100, 1001])]
+        succeed = sum(len(request_times) for _, request_times in urls_request_times)
+        total_time = sum(sum(request_times) for _, request_times in urls_request_times)
+
+        expected = [log_analyzer.get_stats(url, request_times, succeed, total_time)
+                    for url, request_times in urls_request_times]
+        self.assertEqual(log_analyzer.get_stats_batch(urls_request_times, succeed, total_time), expected)
+
+    def test_url_normalizer(self):
+        normalizer = log_analyzer.UrlNormalizer([["/\\d+(?=/|$)", "/{id}"],
+                                                 ["/[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}",
+                                                  "/{uuid}"]],
+                                                strip_query=True)
+        self.assertEqual(normalizer("/api/v2/banner/25019354"), "/api/v2/banner/{id}")
+        self.assertEqual(normalizer("/api/v2/group/1769230/banners"), "/api/v2/group/{id}/banners")
+        self.assertEqual(normalizer("/api/v2/group/7786679/statistic/sites/?date_type=day"),
+                         "/api/v2/group/{id}/statistic/sites/")
+        self.assertEqual(normalizer("/export/2017-06-29/a3bb189e-8bf9-3888-9912-ace4e6543002"),
+                         "/export/2017-06-29/{uuid}")
+        self.assertEqual(log_analyzer.UrlNormalizer()("/api/?a=1"), "/api/?a=1")
+
+    def test_max_urls(self):
+        pattern = log_analyzer.UI_SHORT_PATTERN
+
+        with tempfile.TemporaryDirectory() as log_dir:
+            file_name = os.path.join(log_dir, "test.log")
+            with open(file_name, "w") as log:
+                log.writelines(ui_short_line(i, 0.1) for i in range(1000))
+
+            for workers in (1, 3):
+                for quantile_error in (None, 0.01):
+                    info, url_stats = log_analyzer.parse_log_file(pattern, file_name, workers=workers,
+                                                                  quantile_error=quantile_error, max_urls=10)
+                    self.assertEqual(len(url_stats), 11)
+                    self.assertIn(log_analyzer.OTHER_URLS, url_stats)
+                    self.assertEqual(info["succeed"], 1000)
+                    self.assertAlmostEqual(info["total_time"], 100)
+
+            normalizer = log_analyzer.UrlNormalizer([["/\\d+$", "/{id}"]])
+            info, url_stats = log_analyzer.parse_log_file(pattern, file_name, url_normalizer=normalizer,
+                                                          max_urls=10)
+            self.assertEqual(list(url_stats), ["/api/v2/banner/{id}"])
+            self.assertEqual(len(url_stats["/api/v2/banner/{id}"]), 1000)
+
+    def test_open_log_file(self):
+        data = b"".join(b"line %d\n" % i for i in range(100000))
+        with tempfile.TemporaryDirectory() as log_dir:
+            file_names = []
+            for extension, compress in ((".gz", gzip.compress), (".bz2", bz2.compress)):
+                file_names.append(os.path.join(log_dir, "test.log" + extension))
+                with open(file_names[-1], "wb") as log:
+                    log.write(compress(data))
+            if shutil.which("zstd"):
+                file_names.append(os.path.join(log_dir, "test.log.zst"))
+                subprocess.run(["zstd", "-q", "-o", file_names[-1]], check=True, input=data)
+
+            for file_name in file_names:
+                for decompressor in ("python", "thread", "external"):
+                    with log_analyzer.open_log_file(file_name, decompressor) as log_file:
+                        blocks = list(log_analyzer.read_blocks(log_file, block_size=100000))
+                    self.assertEqual(b"".join(blocks), data, (file_name, decompressor))
+                    self.assertEqual(list(log_analyzer.iter_lines(blocks)), data.splitlines())
+
+            # early close doesn't raise
+            for decompressor in ("thread", "external"):
+                with log_analyzer.open_log_file(file_names[0], decompressor) as log_file:
+                    log_file.read(10)
+
+            broken_file_name = os.path.join(log_dir, "broken.log.gz")
+            with open(broken_file_name, "wb") as log:
+                log.write(gzip.compress(data)[:1000])
+            for decompressor in ("python", "thread", "external"):
+                with self.assertRaises((IOError, EOFError)):
+                    with log_analyzer.open_log_file(broken_file_name, decompressor) as log_file:
+                        list(log_analyzer.read_blocks(log_file))
+
+    def test_iter_mmap_lines(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            file_name = os.path.join(log_dir, "test.log")
+            for data in (b"", b"\n", b"first\n\nsecond\n", b"first\nlast without newline",
+                         b"".join(b"line %d\n" % i for i in range(100000))):
+                with open(file_name, "wb") as log:
+                    log.write(data)
+                with open(file_name, "rb") as log:
+                    expected = list(log_analyzer.iter_lines(log_analyzer.read_blocks(log)))
+                self.assertEqual(list(log_analyzer.iter_mmap_lines(file_name, release_size=4096)), expected)
+                for start, end in log_analyzer.split_log_file(file_name, 3):
+                    with open(file_name, "rb") as log:
+                        self.assertEqual(list(log_analyzer.iter_mmap_lines(file_name, start, end)),
+                                         list(log_analyzer.iter_lines(log_analyzer.read_blocks(log, start, end))))
+
+    def test_run_metrics(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            lines = [ui_short_line(i).rstrip("\n").encode() for i in range(100)] + [b"broken line"] * 5
+            data = b"\n".join(lines) + b"\n"
+            file_name = os.path.join(log_dir, "test.log")
+            with open(file_name, "wb") as log:
+                log.write(data)
+            with gzip.open(file_name + ".gz", "wb") as log:
+                log.write(data)
+
+            metrics = log_analyzer.RunMetrics(profile=True)
+            with metrics.stage("parse", profile=True):
+                log_analyzer.parse_log_file(log_analyzer.UI_SHORT_PATTERN, file_name, metrics=metrics)
+                log_analyzer.parse_log_file(log_analyzer.UI_SHORT_PATTERN, file_name, start=len(lines[0]) + 1,
+                                            metrics=metrics)
+                log_analyzer.parse_log_file(log_analyzer.UI_SHORT_PATTERN, file_name + ".gz", workers=2,
+                                            metrics=metrics)
+            self.assertEqual(metrics.lines, 105 + 104 + 105)
+            self.assertEqual(metrics.failed_lines, 15)
+            self.assertEqual(metrics.read_bytes, 2 * len(data) - len(lines[0]) - 1 + os.path.getsize(file_name + ".gz"))
+            self.assertGreater(metrics.stages["parse"]["wall"], 0)
+
+            report_file_name = os.path.join(log_dir, "report-2017.06.30.html")
+            metrics.save(report_file_name, True)
+            metrics_file_name = os.path.join(log_dir, "report-2017.06.30.prom")
+            with open(metrics_file_name) as metrics_file:
+                samples = dict(line.rsplit(" ", 1) for line in metrics_file.read().splitlines()
+                               if not line.startswith("#"))
+            self.assertEqual(samples['log_analyzer_lines{report="report-2017.06.30"}'], "314")
+            self.assertEqual(samples['log_analyzer_failed_lines{report="report-2017.06.30"}'], "15")
+            self.assertEqual(samples['log_analyzer_last_run_success{report="report-2017.06.30"}'], "1")
+            self.assertIn('log_analyzer_stage_wall_seconds{report="report-2017.06.30",stage="parse"}', samples)
+            self.assertEqual(os.stat(metrics_file_name).st_mode & 0o777, 0o644)
+
+            # without resource module CPU time is of current process only and peak memory is unknown
+            with mock.patch.object(log_analyzer, "resource", None):
+                self.assertGreater(log_analyzer.cpu_time(), 0)
+                self.assertIsNone(log_analyzer.peak_memory())
+                metrics.save(report_file_name, True)
+            with open(metrics_file_name) as metrics_file:
+                text = metrics_file.read()
+            self.assertNotIn("peak_memory_bytes", text)
+            self.assertIn('log_analyzer_lines{report="report-2017.06.30"} 314', text)
+            self.assertTrue(os.path.isfile(os.path.join(log_dir, "report-2017.06.30.pstats")))
+
+    def test_error_rate_early_abort(self):
+        line = ui_short_line().encode()
+        with tempfile.TemporaryDirectory() as log_dir:
+            file_name = os.path.join(log_dir, "test.log")
+
+            # exactly acceptable error rate is not aborted
+            with open(file_name, "wb") as log:
+                log.write(b"".join(b"broken line\n" if i % 10 == 0 else line for i in range(100000)))
+            with self.assertLogs(level="INFO") as logs:
+                info, _ = log_analyzer.parse_log_file(log_analyzer.UI_SHORT_PATTERN, file_name, 0.1,
+                                                      tokenizer=log_analyzer.tokenize_ui_short)
+            self.assertEqual((info["total"], info["succeed"]), (100000, 90000))
+            self.assertEqual(sum("Cannot parse line" in message for message in logs.output),
+                             log_analyzer.ERROR_LOG_LINES)
+            info, _ = log_analyzer.parse_log_file(log_analyzer.UI_SHORT_PATTERN, file_name, 0.1, workers=3,
+                                                  tokenizer=log_analyzer.tokenize_ui_short)
+            self.assertEqual((info["total"], info["succeed"]), (100000, 90000))
+
+            # wrong log format is aborted after the first test of error rate
+            with open(file_name, "wb") as log:
+                log.write(b"".join(b"broken line\n" if i % 5 else line for i in range(1000000)))
+            for workers in (1, 3):
+                metrics = log_analyzer.RunMetrics()
+                with self.assertLogs(level="ERROR"):
+                    self.assertIsNone(log_analyzer.parse_log_file(log_analyzer.UI_SHORT_PATTERN, file_name, 0.1,
+                                                                  workers=workers, metrics=metrics,
+                                                                  tokenizer=log_analyzer.tokenize_ui_short))
+                self.assertEqual(metrics.lines, log_analyzer.ERROR_RATE_MIN_LINES)
+                self.assertEqual(metrics.failed_lines, log_analyzer.ERROR_RATE_MIN_LINES * 4 // 5)
+
+            # error rate of compressed log parsed in blocks is tested on counts of all parsed blocks
+            with gzip.open(file_name + ".gz", "wb") as log:
+                log.write(b"".join(b"broken line\n" if i % 10 == 0 else line for i in range(100000)))
+            info, _ = log_analyzer.parse_log_file_parallel(log_analyzer.UI_SHORT_PATTERN, file_name + ".gz", 3,
+                                                           block_size=64 * 1024, error_rate=0.1,
+                                                           tokenizer=log_analyzer.tokenize_ui_short)
+            self.assertEqual((info["total"], info["succeed"]), (100000, 90000))
+            with gzip.open(file_name + ".gz", "wb") as log:
+                log.write(b"".join(b"broken line\n" if i % 5 else line for i in range(100000)))
+            with self.assertRaises(log_analyzer.ErrorRateExceeded) as error:
+                log_analyzer.parse_log_file_parallel(log_analyzer.UI_SHORT_PATTERN, file_name + ".gz", 3,
+                                                     block_size=64 * 1024, error_rate=0.1,
+                                                     tokenizer=log_analyzer.tokenize_ui_short)
+            self.assertGreaterEqual(error.exception.total, log_analyzer.ERROR_RATE_MIN_LINES)
+            self.assertLess(error.exception.total, 2 * log_analyzer.ERROR_RATE_MIN_LINES)
+
+            # lines which are not valid UTF-8 are counted as errors
+            with open(file_name, "wb") as log:
+                log.write(line + b"\xff\xfe broken\n" + line.replace(b"1.196", b"\xc3.196"))
+            info, _ = log_analyzer.parse_log_file(log_analyzer.UI_SHORT_PATTERN, file_name)
+            self.assertEqual((info["total"], info["succeed"]), (3, 1))
+
+            self.assertTrue(log_analyzer.is_error_rate_exceeded(1000, 200, 0.1, 0.001))
+            self.assertFalse(log_analyzer.is_error_rate_exceeded(1000, 120, 0.1, 0.001))
+
+    def test_write_report_to_html(self):
+        report = [{"url": "/api/v2/banner/{}".format(i), "count": i, "time_sum": i / 10} for i in range(1000)]
+        report.append({"url": "/api/v2/</script><script>alert(1)</script>&", "count": 1, "time_sum": 0.1})
+        template_dir = os.path.dirname(os.path.abspath(log_analyzer.__file__))
+        with tempfile.TemporaryDirectory() as report_dir:
+            report_file_name = os.path.join(report_dir, "report.html")
+            for template in ("report.html", "report_lazy.html"):
+                log_analyzer.write_report_to_html(iter(report), os.path.join(template_dir, template),
+                                                  report_file_name, overwrite=True)
+                with open(report_file_name, encoding="utf-8") as report_file:
+                    html = report_file.read()
+                self.assertNotIn("$table_json", html)
+                self.assertNotIn("<script>alert", html)
+                table_json = re.search(r"var table = (.*);|id=\"report-data\">(.*)</script>", html)
+                self.assertEqual(json.loads(table_json.group(1) or table_json.group(2)), report)
+
+            # the same html as with substitution of the whole json
+            log_analyzer.write_report_to_html(report[:-1], os.path.join(template_dir, "report.html"),
+                                              report_file_name, overwrite=True)
+            with open(os.path.join(template_dir, "report.html"), encoding="utf-8") as template_file, \
+                    open(report_file_name, encoding="utf-8") as report_file:
+                self.assertEqual(report_file.read(),
+                                 Template(template_file.read()).safe_substitute(table_json=json.dumps(report[:-1])))
+
+    def test_make_daily_reports(self):
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            config = dict(log_analyzer.config,
+                          LOG_DIR=os.path.join(work_dir, "log"),
+                          REPORT_DIR=os.path.join(work_dir, "reports"),
+                          AGGREGATE_DIR=os.path.join(work_dir, "aggregates"),
+                          DAILY_AGGREGATES=True,
+                          REPORT_TEMPLATE=os.path.join(os.path.dirname(os.path.abspath(log_analyzer.__file__)),
+                                                       "report.html"),
+                          WORKERS=2,
+                          BATCH_WORKERS=3)
+            os.mkdir(config["LOG_DIR"])
+            os.mkdir(config["REPORT_DIR"])
+            for day in range(1, 6):
+                with open(os.path.join(config["LOG_DIR"], "nginx-access-ui.log-201706{:02d}".format(day)), "w") as log:
+                    log.writelines(ui_short_line(i % (day + 2), i * day / 1000) for i in range(100))
+            with open(os.path.join(config["LOG_DIR"], "nginx-access-ui.log-20170606"), "w") as log:
+                log.write("broken line\n" * 100)
+            open(log_analyzer.daily_report_file_name(config["REPORT_DIR"], date(2017, 6, 1)), "w").close()
+
+            log_files = log_analyzer.find_unreported_log_files(config)
+            self.assertEqual([log_date for _, log_date in log_files], [date(2017, 6, d) for d in range(2, 7)])
+            reported = log_analyzer.make_daily_reports(config, log_files)
+            self.assertEqual(reported, log_files[:-1])
+            for _, log_date in reported:
+                self.assertTrue(os.path.isfile(log_analyzer.daily_report_file_name(config["REPORT_DIR"], log_date)))
+            self.assertEqual(len(os.listdir(config["AGGREGATE_DIR"])), 4)
+            self.assertEqual(log_analyzer.find_unreported_log_files(config), log_files[-1:])
+            self.assertEqual(log_analyzer.find_unreported_log_files(config, min_age=3600), [])
+
+    def test_log_index(self):
+        pattern = log_analyzer.NGINX_FILE_NAME_PATTERN
+        with tempfile.TemporaryDirectory() as log_dir, tempfile.TemporaryDirectory() as index_dir:
+            for file_name in ("nginx-access-ui.log-20170601.gz", "nginx-access-ui.log-20170603",
+                              "nginx-access-ui.log-20170603.bz2", "nginx-access-ui.log-20170631",
+                              "nginx-access-ui.log-20170602.tmp", "nginx-error.log-20170605"):
+                open(os.path.join(log_dir, file_name), "w").close()
+            index_file_name = os.path.join(index_dir, "index.json")
+            expected = [("nginx-access-ui.log-20170601.gz", date(2017, 6, 1)),
+                        ("nginx-access-ui.log-20170603", date(2017, 6, 3))]
+
+            scanned = []
+            scan_log_files = log_analyzer.scan_log_files
+            log_analyzer.scan_log_files = lambda *args: scanned.append(args) or scan_log_files(*args)
+            try:
+                self.assertEqual(log_analyzer.find_log_files(pattern, log_dir), expected)
+                self.assertEqual(log_analyzer.find_last_log_file(pattern, log_dir), expected[-1])
+                self.assertEqual(len(scanned), 2)
+
+                # directory changed right before the scan is scanned again
+                self.assertEqual(log_analyzer.find_log_files(pattern, log_dir, index_file_name=index_file_name),
+                                 expected)
+                self.assertEqual(log_analyzer.find_last_log_file(pattern, log_dir, index_file_name), expected[-1])
+                self.assertEqual(len(scanned), 4)
+
+                os.utime(log_dir, (0, 0))
+                self.assertEqual(log_analyzer.find_log_files(pattern, log_dir, date(2017, 6, 2), date(2017, 6, 3),
+                                                             index_file_name), expected[1:])
+                self.assertEqual(log_analyzer.find_last_log_file(pattern, log_dir, index_file_name), expected[-1])
+                self.assertEqual(log_analyzer.find_log_files(pattern, log_dir, date(2017, 6, 4),
+                                                             index_file_name=index_file_name), [])
+                self.assertEqual(len(scanned), 5)
+
+                # new log file changes directory modification time
+                open(os.path.join(log_dir, "nginx-access-ui.log-20170604"), "w").close()
+                self.assertEqual(log_analyzer.find_last_log_file(pattern, log_dir, index_file_name),
+                                 ("nginx-access-ui.log-20170604", date(2017, 6, 4)))
+                self.assertEqual(len(scanned), 6)
+            finally:
+                log_analyzer.scan_log_files = scan_log_files
+
+    def test_export_columns(self):
+        # the line is parsed by regex, tokenizer rejects lines with several pairs of square brackets
+        regex_line = '1.169.137.128 [-]  - [29/Jun/2017:03:51:00 +0300] "GET /api/v2/banner/[1] HTTP/1.1" 404 - ' \
+                     '"-" "Slotovod" "-" "1498697422-2118016444-4708-9752769" "712e90144abee9" 0.199\n'
+        lines = [ui_short_line(i % 7, i / 1000, (200, 304, 500)[i % 3], i * 10, i % 60) for i in range(3000)]
+        lines[100:100] = ["broken line\n", regex_line]
+        pattern = log_analyzer.UI_SHORT_PATTERN
+        tokenizer = log_analyzer.tokenize_ui_short
+
+        with tempfile.TemporaryDirectory() as log_dir:
+            file_name = os.path.join(log_dir, "test.log")
+            with open(file_name, "w") as log:
+                log.writelines(lines)
+            with gzip.open(file_name + ".gz", "wt") as log:
+                log.writelines(lines)
+
+            export_dir = os.path.join(log_dir, "export")
+            log_analyzer.parse_log_file(pattern, file_name, tokenizer=tokenizer, export_dir=export_dir)
+            columns = log_analyzer.load_columns(export_dir)
+            self.assertEqual(len(columns["request_time"]), 3001)
+            self.assertEqual(list(columns["request_time"][:3]), [0, 0.001, 0.002])
+            self.assertEqual(columns["request_time"][100], 0.199)
+            self.assertEqual(list(columns["status"][99:102]), [200, 404, 304])
+            self.assertEqual(list(columns["body_bytes_send"][99:102]), [990, -1, 1000])
+            self.assertEqual(columns["time_local"][0], 1498697400)
+            self.assertEqual(columns["time_local"][100], 1498697460)
+            self.assertEqual([columns["urls"][url] for url in columns["url"][99:102]],
+                             ["/api/v2/banner/1", "/api/v2/banner/[1]", "/api/v2/banner/2"])
+
+            # file is exported in the same order by workers and by chunks
+            self.assertEqual(log_analyzer.load_columns(export_dir, ("status",)), {"status": columns["status"]})
+            for options in ({"workers": 3}, {"workers": 2, "use_mmap": True}):
+                log_analyzer.parse_log_file(pattern, file_name, tokenizer=tokenizer, export_dir=export_dir, **options)
+                self.assertEqual(log_analyzer.load_columns(export_dir), columns)
+            shutil.rmtree(export_dir)
+            os.mkdir(export_dir)
+            log_analyzer.parse_log_file_parallel(pattern, file_name + ".gz", 2, block_size=10000, tokenizer=tokenizer,
+                                                 export_dir=export_dir)
+            self.assertGreater(len(os.listdir(export_dir)), 6 * 5)
+            self.assertEqual(log_analyzer.load_columns(export_dir), columns)
+
+            # appended lines are exported as new chunks
+            log_analyzer.parse_log_file(pattern, file_name, tokenizer=tokenizer, export_dir=export_dir)
+            start = os.path.getsize(file_name)
+            with open(file_name, "a") as log:
+                log.writelines(lines[:10])
+            log_analyzer.parse_log_file(pattern, file_name, start=start, tokenizer=tokenizer, export_dir=export_dir)
+            self.assertEqual(list(log_analyzer.load_columns(export_dir)["request_time"]),
+                             list(columns["request_time"]) + list(columns["request_time"][:10]))
+
+            # chunk columns are .npy files
+            with open(os.path.join(export_dir, sorted(os.listdir(export_dir))[0]), "rb") as npy_file:
+                self.assertEqual(npy_file.read(6), b"\x93NUMPY")
+                npy_file.seek(8)
+                self.assertEqual((10 + int.from_bytes(npy_file.read(2), "little")) % 64, 0)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -27,9 +27,25 @@
 # Можно свободно определять свои функции и т.п.
 # -----------------
 
-from itertools import combinations
+import math
+import multiprocessing
+import random
 
+from itertools import combinations, combinations_with_replacement, product
+from statistics import NormalDist
 
+from deco import timed
+
+RANKS = '23456789TJQKA'
+SUITS = 'CSHD'
+PRIMES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41)
+PRIME_BITS = 0xFF
+SUIT_BITS = 0xF00
+JOKER_CARDS = {'?B': [rank + suit for suit in 'CS' for rank in RANKS],
+               '?R': [rank + suit for suit in 'HD' for rank in RANKS]}
+
+
+@timed(sample=100)
 def hand_rank(hand):
     """Возвращает значение определяющее ранг 'руки'"""
     ranks = card_ranks(hand)
@@ -98,18 +114,255 @@ def two_pair(ranks):
     return good_ranks if len(good_ranks) == 2 else None
 
 
+def encode_card(card):
+    """Кодирует карту целым числом: простое число ранга в битах 0-7,
+    бит масти в битах 8-11 и бит ранга в битах 16-28"""
+    rank = RANKS.index(card[0])
+    return PRIMES[rank] | 1 << (8 + SUITS.index(card[1])) | 1 << (16 + rank)
+
+
+CARD_CODES = {rank + suit: encode_card(rank + suit) for rank in RANKS for suit in SUITS}
+CODE_CARDS = {code: card for card, code in CARD_CODES.items()}
+# маски рангов стритов от старшего к младшему
+STRAIGHT_MASKS = [0b11111 << low for low in range(len(RANKS) - 5, -1, -1)]
+
+
+def encode_hand(hand):
+    """Возвращает список кодов карт 'руки'"""
+    return [CARD_CODES[card] for card in hand]
+
+
+def build_rank_tables():
+    """Возвращает таблицы значений 5ти карт: флешей по маске рангов
+    и остальных рук по произведению простых чисел рангов.
+    Значение - номер значения hand_rank среди всех возможных,
+    поэтому значения упорядочены так же, как hand_rank"""
+    hands = []
+    for ranks in combinations(RANKS, 5):
+        hands.append((True, [rank + 'C' for rank in ranks]))
+    for ranks in combinations_with_replacement(RANKS, 5):
+        if max(ranks.count(rank) for rank in ranks) > 4:
+            continue
+        hand = [rank + SUITS[ranks[:i].count(rank)] for i, rank in enumerate(ranks)]
+        if flush(hand):
+            hand[-1] = hand[-1][0] + 'S'
+        hands.append((False, hand))
+
+    flush_table = {}
+    product_table = {}
+    ranked = sorted(((hand_rank(hand), is_flush, encode_hand(hand)) for is_flush, hand in hands),
+                    key=lambda item: item[0])
+    value = 0
+    for i, (rank, is_flush, cards) in enumerate(ranked):
+        if i and rank != ranked[i - 1][0]:
+            value += 1
+        if is_flush:
+            mask = 0
+            for card in cards:
+                mask |= card
+            flush_table[mask >> 16] = value
+        else:
+            product = 1
+            for card in cards:
+                product *= card & PRIME_BITS
+            product_table[product] = value
+    return flush_table, product_table
+
+
+FLUSH_TABLE, PRODUCT_TABLE = build_rank_tables()
+
+
+def evaluate(cards):
+    """Возвращает значение 5ти закодированных карт из таблиц,
+    значения сравниваются так же, как значения hand_rank"""
+    c1, c2, c3, c4, c5 = cards
+    if c1 & c2 & c3 & c4 & c5 & SUIT_BITS:
+        return FLUSH_TABLE[(c1 | c2 | c3 | c4 | c5) >> 16]
+    return PRODUCT_TABLE[(c1 & PRIME_BITS) * (c2 & PRIME_BITS) * (c3 & PRIME_BITS) *
+                         (c4 & PRIME_BITS) * (c5 & PRIME_BITS)]
+
+
+def fast_hand_rank(hand):
+    """hand_rank через таблицы: возвращает число, которое
+    упорядочивает 'руки' так же, как hand_rank"""
+    return evaluate(encode_hand(hand))
+
+
 def best_hand(hand):
-    """Из "руки" в 7 карт возвращает лучшую "руку" в 5 карт """
+    """Из "руки" в 7 карт возвращает лучшую "руку" в 5 карт
+    без перебора 21 сочетания, см. best_five"""
+    return [CODE_CARDS[code] for code in best_five(encode_hand(hand))]
+
+
+def best_hand_naive(hand):
+    """best_hand перебором всех 'рук' из 5ти карт"""
     return max((comb for comb in combinations(hand, 5)), key=hand_rank)
 
 
+def best_five(cards):
+    """Лучшие 5 из 7ми закодированных карт без перебора сочетаний: карты
+    группируются по рангам и мастям за один проход по картам, отсортированным
+    по убыванию ранга. Комбинации выбираются так же, как их сравнивает hand_rank,
+    в том числе без стрита с младшим тузом"""
+    cards = sorted(cards, reverse=True)
+    suited = {}
+    groups = []
+    mask = 0
+    for card in cards:
+        suited.setdefault(card & SUIT_BITS, []).append(card)
+        if groups and (groups[-1][0] ^ card) >> 16 == 0:
+            groups[-1].append(card)
+        else:
+            groups.append([card])
+        mask |= card
+    mask >>= 16
+
+    flush_cards = None
+    for suit_cards in suited.values():
+        if len(suit_cards) >= 5:
+            suit_mask = 0
+            for card in suit_cards:
+                suit_mask |= card
+            suit_mask >>= 16
+            for straight_mask in STRAIGHT_MASKS:
+                if suit_mask & straight_mask == straight_mask:
+                    return [card for card in suit_cards if card >> 16 & straight_mask]
+            flush_cards = suit_cards[:5]
+
+    by_size = sorted(groups, key=len, reverse=True)
+    first, second = by_size[0], by_size[1]
+    if len(first) == 4:
+        return first + [card for card in cards if card not in first][:1]
+    if len(first) == 3 and len(second) >= 2:
+        return first + second[:2]
+    if flush_cards:
+        return flush_cards
+    for straight_mask in STRAIGHT_MASKS:
+        if mask & straight_mask == straight_mask:
+            return [group[0] for group in groups if group[0] >> 16 & straight_mask]
+    if len(first) == 3:
+        return first + [card for card in cards if card not in first][:2]
+    if len(first) == 2 and len(second) == 2:
+        return first + second + [card for card in cards if card not in first and card not in second][:1]
+    if len(first) == 2:
+        return first + [card for card in cards if card not in first][:3]
+    return cards[:5]
+
+
+def best_combination(fixed, cards):
+    """Возвращает значение evaluate и лучшую 'руку' из всех карт fixed
+    и недостающих до 5ти карт из cards, (-1, None) если карт не хватает"""
+    best = (-1, None)
+    fixed_codes = encode_hand(fixed)
+    for comb in combinations(cards, 5 - len(fixed)):
+        value = evaluate(fixed_codes + encode_hand(comb))
+        if value > best[0]:
+            best = (value, list(fixed) + list(comb))
+    return best
+
+
+def straight_ranks(ranks, jokers):
+    """Ранги, которых не хватает для стрита, если не хватает не больше jokers карт"""
+    missing = set()
+    for low in range(len(RANKS) - 4):
+        window = set(RANKS[low:low + 5]) - ranks
+        if len(window) <= jokers:
+            missing |= window
+    return missing
+
+
+def joker_candidates(naturals, joker, jokers):
+    """Карты, которыми имеет смысл заменять джокера: ранги карт из руки (пары, сеты),
+    ранги, дополняющие стрит, и старший из остальных рангов как кикер.
+    Остальные ранги не дополняют комбинаций и дают руку не лучше старшего"""
+    ranks = {card[0] for card in naturals}
+    useful = ranks | straight_ranks(ranks, jokers)
+    others = [rank for rank in RANKS if rank not in ranks]
+    if others:
+        useful.add(others[-1])
+    return [card for card in JOKER_CARDS[joker] if card[0] in useful and card not in naturals]
+
+
 def best_wild_hand(hand):
-    """best_hand но с джокерами"""
-    # black_cards = ["2C", "3C", "4C", "5C", "6C", "7C", "8C", "9C", "TC", "JC", "QC", "KC", "AC",
-    #                "2S", "3S", "4S", "5S", "6S", "7S", "8S", "9S", "TS", "JS", "QS", "KS", "AS"]
-    # red_cards = ["2D", "3D", "4D", "5D", "6D", "7D", "8D", "9D", "TD", "JD", "QD", "KD", "AD",
-    #              "2H", "3H", "4H", "5H", "6H", "7H", "8H", "9H", "TH", "JH", "QH", "KH", "AH"]
-    return
+    """best_hand но с джокерами. Лучшая 'рука' ищется отдельно среди карт без джокеров,
+    с одним джокером и с двумя, поэтому комбинации с одним джокером оцениваются
+    один раз для всех замен другого джокера. Флеш с двумя джокерами разного цвета
+    невозможен, поэтому для пары джокеров масть карты не важна"""
+    naturals = [card for card in hand if card[0] != '?']
+    jokers = [card for card in hand if card[0] == '?']
+    candidates = [joker_candidates(naturals, joker, len(jokers)) for joker in jokers]
+
+    results = [best_combination((), naturals)]
+    for cards in candidates:
+        results.extend(best_combination((card,), naturals) for card in cards)
+    if len(jokers) == 2:
+        black, red = ({card[0]: card for card in cards}.values() for cards in candidates)
+        results.extend(best_combination((first, second), naturals) for first in black for second in red)
+    return max(results, key=lambda result: result[0])[1]
+
+
+def best_wild_hand_naive(hand):
+    """best_wild_hand перебором всех замен джокеров и всех 'рук' из 5ти карт"""
+    naturals = [card for card in hand if card[0] != '?']
+    substitutions = [[card for card in JOKER_CARDS[joker] if card not in naturals]
+                     for joker in hand if joker[0] == '?']
+    return max((best_hand_naive(naturals + list(cards)) for cards in product(*substitutions)), key=hand_rank)
+
+
+def rank7(cards):
+    """Значение лучшей 'руки' из 5ти карт среди 7ми закодированных карт"""
+    return evaluate(best_five(cards))
+
+
+def simulate(players, board, deck, trials, seed):
+    """Раздает недостающие карты стола trials раз генератором с seed,
+    возвращает суммы долей банка игроков и суммы их квадратов"""
+    generator = random.Random(seed)
+    missing = 5 - len(board)
+    sums = [0.0] * len(players)
+    squares = [0.0] * len(players)
+    for _ in range(trials):
+        table = board + generator.sample(deck, missing)
+        values = [rank7(cards + table) for cards in players]
+        best = max(values)
+        winners = values.count(best)
+        for i, value in enumerate(values):
+            if value == best:
+                sums[i] += 1 / winners
+                squares[i] += 1 / winners ** 2
+    return sums, squares
+
+
+def equity(hole_cards, board=(), trials=100000, seed=0, workers=1, batch_size=10000, confidence=0.95):
+    """Оценивает методом Монте-Карло долю банка каждого игрока по их картам
+    и известным картам стола. Раздачи делятся на пачки по batch_size,
+    у каждой пачки свой seed из генератора с seed, поэтому результат
+    не зависит от числа процессов workers. Возвращает для каждого игрока
+    долю банка и границы ее доверительного интервала"""
+    known = [card for cards in hole_cards for card in cards] + list(board)
+    if len(set(known)) != len(known) or len(board) > 5:
+        raise ValueError("Cards are repeated or board has more than 5 cards")
+    players = [encode_hand(cards) for cards in hole_cards]
+    table = encode_hand(board)
+    deck = [code for card, code in CARD_CODES.items() if card not in known]
+
+    generator = random.Random(seed)
+    batches = [(players, table, deck, min(batch_size, trials - start), generator.getrandbits(64))
+               for start in range(0, trials, batch_size)]
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.starmap(simulate, batches)
+    else:
+        results = [simulate(*batch) for batch in batches]
+
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    estimates = []
+    for i in range(len(players)):
+        mean = sum(sums[i] for sums, _ in results) / trials
+        variance = max(sum(squares[i] for _, squares in results) / trials - mean ** 2, 0)
+        error = z * math.sqrt(variance / trials)
+        estimates.append((mean, max(mean - error, 0), min(mean + error, 1)))
+    return estimates
 
 
 def test_best_hand():
@@ -125,6 +378,23 @@ def test_best_hand():
     print('OK')
 
 
+def test_fast_hand_rank():
+    print("test_fast_hand_rank...")
+    assert fast_hand_rank("6C 7C 8C 9C TC".split()) > fast_hand_rank("7D 7S 7H 7C 2D".split())
+    assert fast_hand_rank("AC 2D 3H 4S 5C".split()) < fast_hand_rank("2D 3H 4S 5C 6C".split())
+    assert fast_hand_rank("TD TC 8H 8C 2C".split()) == fast_hand_rank("TH TS 8D 8S 2D".split())
+    # случайные руки упорядочены так же, как hand_rank
+    generator = random.Random(19)
+    deck = [rank + suit for rank in RANKS for suit in SUITS]
+    hands = sorted((generator.sample(deck, 5) for _ in range(3000)), key=hand_rank)
+    for previous, hand in zip(hands, hands[1:]):
+        if hand_rank(previous) == hand_rank(hand):
+            assert fast_hand_rank(previous) == fast_hand_rank(hand)
+        else:
+            assert fast_hand_rank(previous) < fast_hand_rank(hand)
+    print('OK')
+
+
 def test_best_wild_hand():
     print("test_best_wild_hand...")
     assert (sorted(best_wild_hand("6C 7C 8C 9C TC 5C ?B".split()))
@@ -136,6 +406,57 @@ def test_best_wild_hand():
     print('OK')
 
 
+def test_best_wild_hand_naive():
+    print("test_best_wild_hand_naive...")
+    generator = random.Random(20)
+    for i in range(30):
+        ranks = generator.sample(RANKS, generator.randint(5, 8))
+        cards = [rank + suit for rank in ranks for suit in generator.sample(SUITS, generator.randint(1, 3))]
+        jokers = [['?B'], ['?R'], ['?B', '?R']][i % 3]
+        if len(cards) < 7 - len(jokers):
+            continue
+        hand = generator.sample(cards, 7 - len(jokers)) + jokers
+        assert hand_rank(best_wild_hand(hand)) == hand_rank(best_wild_hand_naive(hand)), hand
+    print('OK')
+
+
+def test_best_hand_naive():
+    print("test_best_hand_naive...")
+    for hand in ("6C 7C 8C 9C TC 5C JS", "TD TC TH 7C 7D 8C 8S", "JD TC TH 7C 7D 7S 7H", "TD TC JH 7C 7D 8C 8S"):
+        assert sorted(best_hand_naive(hand.split())) == sorted(best_hand(hand.split()))
+    assert (sorted(best_hand("AS 2D 3C 4H 5S 9D 9C".split()))
+            == ['4H', '5S', '9C', '9D', 'AS'])
+    generator = random.Random(22)
+    deck = [rank + suit for rank in RANKS for suit in SUITS]
+    for i in range(2000):
+        if i % 2:
+            cards = [rank + suit for rank in generator.sample(RANKS, generator.randint(4, 8))
+                     for suit in generator.sample(SUITS, generator.randint(2, 4))]
+        else:
+            cards = deck
+        hand = generator.sample(cards, 7) if len(cards) >= 7 else generator.sample(deck, 7)
+        best = best_hand(hand)
+        assert len(set(best)) == 5 and set(best) <= set(hand), hand
+        assert hand_rank(best) == hand_rank(best_hand_naive(hand)), hand
+    print('OK')
+
+
+def test_equity():
+    print("test_equity...")
+    (aces, low, high), (kings, _, _) = equity(["AS AH".split(), "KS KH".split()], trials=20000, seed=1)
+    assert low < aces < high and abs(aces - 0.82) < 0.02 and abs(aces + kings - 1) < 1e-9
+    assert (equity(["AS AH".split(), "KS KH".split()], trials=3000, seed=2, batch_size=1000, workers=2)
+            == equity(["AS AH".split(), "KS KH".split()], trials=3000, seed=2, batch_size=1000))
+    # стол известен полностью: ничья делит банк
+    assert (equity(["2S 3H".split(), "2C 3D".split()], "AS KS QH JD TC".split(), trials=10)
+            == [(0.5, 0.5, 0.5), (0.5, 0.5, 0.5)])
+    print('OK')
+
+
 if __name__ == '__main__':
     test_best_hand()
-    # test_best_wild_hand()
+    test_fast_hand_rank()
+    test_best_wild_hand()
+    test_best_wild_hand_naive()
+    test_best_hand_naive()
+    test_equity()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import optparse
+import os
+import random
+import time
+
+from itertools import combinations
+
+import poker
+
+DECK = [rank + suit for rank in poker.RANKS for suit in poker.SUITS]
+
+
+def random_hands(count, size, seed):
+    """Deterministic list of random hands of size cards"""
+
+    generator = random.Random(seed)
+    return [generator.sample(DECK, size) for _ in range(count)]
+
+
+def hands_per_second(func, hands):
+    """Rate of func calls on hands"""
+
+    started = time.perf_counter()
+    for hand in hands:
+        func(hand)
+    return len(hands) / (time.perf_counter() - started)
+
+
+def benchmark_hand_rank(count, seed):
+    """Compare hand_rank with lookup table evaluator on the same 5-card hands"""
+
+    hands = random_hands(count, 5, seed)
+    encoded = [poker.encode_hand(hand) for hand in hands]
+    return {"hand_rank": hands_per_second(poker.hand_rank, hands),
+            "fast_hand_rank": hands_per_second(poker.fast_hand_rank, hands),
+            "evaluate (encoded cards)": hands_per_second(poker.evaluate, encoded)}
+
+
+def benchmark_best_hand(count, seed):
+    """Compare best_hand with enumeration of all 5-card combinations on the same 7-card hands"""
+
+    hands = random_hands(count, 7, seed)
+    encoded = [poker.encode_hand(hand) for hand in hands]
+    return {"best_hand_naive": hands_per_second(poker.best_hand_naive, hands[:count // 20]),
+            "best_hand": hands_per_second(poker.best_hand, hands),
+            "evaluate of 21 (encoded)": hands_per_second(lambda cards: max(map(poker.evaluate,
+                                                                                combinations(cards, 5))), encoded),
+            "rank7 (encoded cards)": hands_per_second(poker.rank7, encoded)}
+
+
+def random_wild_hands(count, seed):
+    """Deterministic list of random hands with one or two jokers"""
+
+    generator = random.Random(seed)
+    hands = []
+    for i in range(count):
+        jokers = [["?B"], ["?R"], ["?B", "?R"]][i % 3]
+        hands.append(generator.sample(DECK, 7 - len(jokers)) + jokers)
+    return hands
+
+
+def benchmark_wild_hand(count, seed):
+    """Compare pruned best_wild_hand with enumeration of all joker substitutions"""
+
+    hands = random_wild_hands(count, seed)
+    return {"best_wild_hand_naive": hands_per_second(poker.best_wild_hand_naive, hands),
+            "best_wild_hand": hands_per_second(poker.best_wild_hand, hands)}
+
+
+def benchmark_equity(trials, workers_counts, seed):
+    """Rate of equity simulation of heads-up preflop hands with different numbers of processes"""
+
+    results = {}
+    for workers in workers_counts:
+        started = time.perf_counter()
+        poker.equity(["AS AH".split(), "KS KH".split()], trials=trials, seed=seed, workers=workers)
+        results["equity workers={}".format(workers)] = trials / (time.perf_counter() - started)
+    return results
+
+
+def print_results(title, results):
+    baseline = next(iter(results.values()))
+    print(title)
+    for name, rate in results.items():
+        print("  {:<28} {:>12,.0f} hands/s  x{:.1f}".format(name, rate, rate / baseline))
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--hands", dest="hands", default=200000, type="int",
+                      help="number of random hands")
+    parser.add_option("--seed", dest="seed", default=46, type="int",
+                      help="seed of random hands")
+    parser.add_option("--wild-hands", dest="wild_hands", default=60, type="int",
+                      help="number of random hands with jokers")
+    parser.add_option("--trials", dest="trials", default=100000, type="int",
+                      help="number of deals of equity simulation")
+    parser.add_option("--workers", dest="workers", default=None, type="string",
+                      help="comma separated numbers of equity processes, default is 1 and number of CPUs")
+    options, args = parser.parse_args()
+    workers_counts = ([int(workers) for workers in options.workers.split(",")] if options.workers
+                      else sorted({1, os.cpu_count()}))
+
+    print_results("5-card hands:", benchmark_hand_rank(options.hands, options.seed))
+    print_results("7-card hands:", benchmark_best_hand(options.hands // 4, options.seed))
+    print_results("7-card hands with jokers:", benchmark_wild_hand(options.wild_hands, options.seed))
+    print_results("Equity deals:", benchmark_equity(options.trials, workers_counts, options.seed))
+
+
+if __name__ == "__main__":
+    main()